@@ -3,7 +3,6 @@ import difflib
 from collections import defaultdict
 
 from six import string_types, text_type
-from elasticsearch_dsl.connections import connections
 from django.conf import settings
 from .indexes import registry
 
@@ -64,10 +63,13 @@ def existing_analysis(using):
     """
     Get the existing analysis for the `using` Elasticsearch connection
     """
-    es = connections.get_connection(using)
+    es = registry.get_connection(using)
     index_name = settings.ELASTICSEARCH_CONNECTIONS[using]['index_name']
     if es.indices.exists(index=index_name):
-        return stringer(es.indices.get_settings(index=index_name)[index_name]['settings']['index'].get('analysis', {}))
+        # the index_name could be an alias, so the settings are keyed by the
+        # name of the index it points to
+        index_settings = next(iter(es.indices.get_settings(index=index_name).values()))
+        return stringer(index_settings['settings']['index'].get('analysis', {}))
     return DOES_NOT_EXIST
 
 
@@ -0,0 +1,203 @@
+import json
+import time
+import random
+from itertools import chain
+
+from elasticsearch import TransportError
+from elasticsearch.helpers import BulkIndexError, expand_action
+
+
+# the status ES uses when a node's bulk queue is full
+TOO_MANY_REQUESTS = 429
+
+
+class AdaptiveBulkSender:
+    """
+    Sends bulk actions to ES in chunks that are sized to keep each request
+    close to `target_latency` seconds (and under `max_chunk_bytes`).
+
+    When ES rejects actions because it is too busy (a 429), the chunk size is
+    halved, and only the rejected actions are retried after an exponential
+    backoff with jitter. Actions that fail for any other reason (or are still
+    rejected after `max_retries`) are errors, and they are appended to the
+    `dead_letter` NDJSON file, if one is given, so they can be inspected and
+    replayed later
+    """
+    def __init__(
+        self,
+        client,
+        chunk_size=500,
+        min_chunk_size=10,
+        max_chunk_size=5000,
+        max_chunk_bytes=10 * 1024 * 1024,
+        target_latency=1.0,
+        max_retries=8,
+        initial_backoff=0.5,
+        max_backoff=60,
+        dead_letter=None,
+        ignore_status=(),
+    ):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.dead_letter = dead_letter
+        # the statuses that are expected, and aren't errors (like version
+        # conflicts)
+        self.ignore_status = frozenset(ignore_status)
+        self.success = 0
+        self.errors = []
+        # the indexes the actions were sent to
+        self.indexes = set()
+
+    def serialize(self, action):
+        """
+        Returns the bulk request lines for the action
+        """
+        serializer = self.client.transport.serializer
+        header, data = expand_action(action)
+        lines = [serializer.dumps(header)]
+        if data is not None:
+            lines.append(serializer.dumps(data))
+        return "\n".join(lines) + "\n"
+
+    def chunks(self, actions):
+        """
+        Yields lists of (action, serialized) pairs, using the chunk size at
+        the time each chunk is started
+        """
+        chunk, size = [], 0
+        for action in actions:
+            serialized = self.serialize(action)
+            if action.get('_index'):
+                self.indexes.add(action['_index'])
+            # the chunk size can change while a chunk is being filled, since
+            # the chunks are sent as they are yielded
+            if chunk and (len(chunk) >= self.chunk_size or size + len(serialized) > self.max_chunk_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append((action, serialized))
+            size += len(serialized)
+
+        if chunk:
+            yield chunk
+
+    def backoff(self, attempt):
+        """
+        Sleep before retrying. The jitter keeps the workers that were rejected
+        at the same time from retrying at the same time
+        """
+        delay = min(self.max_backoff, self.initial_backoff * (2 ** attempt))
+        time.sleep(random.uniform(delay / 2, delay))
+
+    def shrink(self):
+        self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+
+    def adapt(self, latency):
+        """
+        Grow the chunk size while requests are fast, and shrink it when they
+        are slow
+        """
+        if latency < self.target_latency / 2:
+            self.chunk_size = min(self.max_chunk_size, int(self.chunk_size * 1.5) + 1)
+        elif latency > self.target_latency * 2:
+            self.shrink()
+
+    def send_chunk(self, chunk, **params):
+        """
+        Send the chunk, retrying the rejected actions
+        """
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                response = self.client.bulk(body="".join(serialized for action, serialized in chunk), **params)
+            except TransportError as e:
+                if e.status_code != TOO_MANY_REQUESTS:
+                    raise
+                # the whole request was rejected
+                rejected = [(action, serialized, {"status": TOO_MANY_REQUESTS, "error": str(e)}) for action, serialized in chunk]
+            else:
+                rejected = []
+                for (action, serialized), item in zip(chunk, response['items']):
+                    op_type, info = next(iter(item.items()))
+                    status = info.get('status', 200)
+                    if status == TOO_MANY_REQUESTS:
+                        rejected.append((action, serialized, item))
+                    elif 200 <= status < 300 or status in self.ignore_status:
+                        self.success += 1
+                    else:
+                        self.fail(action, item)
+
+                if not rejected:
+                    self.adapt(time.monotonic() - started)
+                    return
+
+            chunk = [(action, serialized) for action, serialized, item in rejected]
+            self.shrink()
+            if attempt < self.max_retries:
+                self.backoff(attempt)
+
+        # give up on the actions that are still being rejected
+        for action, serialized, item in rejected:
+            self.fail(action, item)
+
+    def fail(self, action, item):
+        self.errors.append(item)
+        if self.dead_letter:
+            with open(self.dead_letter, "a") as f:
+                f.write(json.dumps({"action": action, "error": item}, default=str) + "\n")
+
+    def send(self, actions, refresh=False, **params):
+        """
+        Send all the actions. If refresh is True, the indexes they were sent
+        to are refreshed at the end
+        """
+        chunks = self.chunks(actions)
+        first = next(chunks, None)
+        if first is None:
+            return self.success, self.errors
+
+        second = next(chunks, None)
+        if second is None:
+            # ES can refresh as part of a single request, which saves a round
+            # trip on every save() and delete()
+            self.send_chunk(first, **dict(params, refresh=True) if refresh else params)
+            return self.success, self.errors
+
+        for chunk in chain([first, second], chunks):
+            self.send_chunk(chunk, **params)
+
+        indexes = self.indexes | set([params['index']] if params.get('index') else [])
+        if refresh and indexes:
+            # one refresh at the end is much cheaper than one per chunk
+            self.client.indices.refresh(index=",".join(sorted(indexes)))
+        return self.success, self.errors
+
+
+def bulk(client, actions, stats_only=False, raise_on_error=True, refresh=False, dead_letter=None, ignore_status=(), **kwargs):
+    """
+    A replacement for elasticsearch.helpers.bulk() that uses the
+    AdaptiveBulkSender. Extra kwargs are used to configure the sender, or
+    passed to the bulk API.
+
+    Returns a two-tuple of the number of successful actions, and the list of
+    errors (or the number of errors if stats_only is True). If raise_on_error
+    is True, a BulkIndexError is raised if there were any errors (after they
+    are written to the dead_letter file)
+    """
+    sender_kwargs = dict(
+        (key, kwargs.pop(key)) for key in list(kwargs)
+        if key in ("chunk_size", "min_chunk_size", "max_chunk_size", "max_chunk_bytes", "target_latency", "max_retries", "initial_backoff", "max_backoff")
+    )
+    sender = AdaptiveBulkSender(client, dead_letter=dead_letter, ignore_status=ignore_status, **sender_kwargs)
+    success, errors = sender.send(actions, refresh=refresh, **kwargs)
+
+    if raise_on_error and errors:
+        raise BulkIndexError("%i document(s) failed to index." % len(errors), errors)
+
+    return success, len(errors) if stats_only else errors
@@ -0,0 +1,27 @@
+from django.core import checks
+
+from .exceptions import ElasticModelsError
+from .indexes import registry
+
+
+# this is a deploy check, so it only runs with `manage.py check --deploy`.
+# Running it with every management command would build every mapping up front
+@checks.register("elasticmodels", deploy=True)
+def check_indexes(app_configs=None, **kwargs):
+    """
+    Build the mapping of every Index, which is otherwise put off until the
+    Index is first used, so mistakes in Meta.fields are reported without
+    waiting for the Index to be used
+    """
+    errors = []
+    for index in registry.get_indexes():
+        model = index._doc_type.model
+        if app_configs is not None and model._meta.app_config not in app_configs:
+            continue
+
+        try:
+            index._doc_type.build()
+        except ElasticModelsError as e:
+            errors.append(checks.Error(str(e), obj=index.index.__class__, id="elasticmodels.E001"))
+
+    return errors
@@ -12,3 +12,7 @@ class RedeclaredFieldError(ElasticModelsError):
 
 class ModelFieldNotMappedError(ElasticModelsError):
     pass
+
+
+class InvalidPartitionError(ElasticModelsError):
+    pass
@@ -6,8 +6,11 @@ from .exceptions import VariableLookupError
 
 
 class EMField(Field):
-    def __init__(self, attr=None, **kwargs):
+    def __init__(self, attr=None, source=True, **kwargs):
         super().__init__(**kwargs)
+        # when False, the field is indexed (so it can be searched), but left
+        # out of the _source ES stores for each document
+        self._in_source = source
         # `self.path` is a list of attributes to lookup on a model instance to
         # generate the value for this field when it is going to index a model
         # object. For example, a path of ['foo', 'bar'] would get the value of
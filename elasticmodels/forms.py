@@ -1,8 +1,22 @@
+import json
+import threading
+from collections import OrderedDict
+
+from elasticsearch import RequestError
 from elasticsearch_dsl import Search
 from django import forms
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.paginator import Paginator, Page, EmptyPage, PageNotAnInteger
 from django.conf import settings
 
+from .search import hydrate, source_results, get_async_connection, run_sync
+
+
+# a process wide LRU cache of validate_query results, keyed by the normalized
+# query (see BaseSearchForm.validation_cache_key)
+validation_cache = OrderedDict()
+validation_cache_lock = threading.Lock()
+
+
 class BaseSearchForm(forms.Form):
     """
     This is the base form class for search forms. It comes with a a nice q
@@ -12,6 +26,17 @@ class BaseSearchForm(forms.Form):
     """
     q = forms.CharField(required=False, label="", widget=forms.widgets.TextInput(attrs={"placeholder": "Search"}))
 
+    # when True, the query is checked with the validate_query API before the
+    # search is run. When False, the search is run directly, and if ES
+    # rejects the query, the "invalid-query" error is added to the form
+    prevalidate_query = True
+    # the maximum number of validate_query results to remember when
+    # prevalidate_query is True. 0 disables the cache
+    validation_cache_size = 0
+    # when True, the results are SourceResult objects built from the _source
+    # of each hit, instead of model instances loaded from the database
+    source_only = False
+
     def __init__(self, data, *args, index, **kwargs):
         self.index = index
         super().__init__(data, **kwargs)
@@ -89,15 +114,75 @@ class BaseSearchForm(forms.Form):
         """
         return self.index.objects.get_queryset()
 
-    def is_valid_query(self, search_instance):
-        validate = self.index.objects.es.indices.validate_query(
+    def validation_cache_key(self, search_instance):
+        """
+        Returns the key used to remember if a query is valid. Two searches
+        with the same query (regardless of the ordering of the keys in
+        the query dict) share a key
+        """
+        return (
+            self.index._doc_type.using,
+            self.index._doc_type.index,
+            self.index._doc_type.mapping.doc_type,
+            json.dumps(search_instance.to_dict()['query'], sort_keys=True, default=str),
+        )
+
+    def get_cached_validation(self, search_instance):
+        """
+        Returns the remembered validate_query result for the search, or None
+        """
+        if not self.validation_cache_size:
+            return None
+
+        key = self.validation_cache_key(search_instance)
+        with validation_cache_lock:
+            if key in validation_cache:
+                validation_cache.move_to_end(key)
+                return validation_cache[key]
+        return None
+
+    def set_cached_validation(self, search_instance, valid):
+        if not self.validation_cache_size:
+            return
+
+        key = self.validation_cache_key(search_instance)
+        with validation_cache_lock:
+            validation_cache[key] = valid
+            while len(validation_cache) > self.validation_cache_size:
+                validation_cache.popitem(last=False)
+
+    def get_validate_query_kwargs(self, search_instance):
+        return dict(
             index=self.index._doc_type.index,
             doc_type=self.index._doc_type.mapping.doc_type,
             body={'query': search_instance.to_dict()['query']},
             explain=True,
         )
 
-        return validate['valid']
+    def is_valid_query(self, search_instance):
+        valid = self.get_cached_validation(search_instance)
+        if valid is None:
+            validate = self.index.objects.es.indices.validate_query(**self.get_validate_query_kwargs(search_instance))
+            valid = validate['valid']
+            self.set_cached_validation(search_instance, valid)
+
+        return valid
+
+    async def ais_valid_query(self, search_instance):
+        """
+        The asyncio version of is_valid_query()
+        """
+        valid = self.get_cached_validation(search_instance)
+        if valid is None:
+            es = get_async_connection(self.index._doc_type.using)
+            validate = await es.indices.validate_query(**self.get_validate_query_kwargs(search_instance))
+            valid = validate['valid']
+            self.set_cached_validation(search_instance, valid)
+
+        return valid
+
+    def add_invalid_query_error(self):
+        self.add_error(None, forms.ValidationError("Invalid Query", code="invalid-query"))
 
     def results(self):
         """
@@ -115,12 +200,52 @@ class BaseSearchForm(forms.Form):
         if not isinstance(objects, Search):
             return objects
 
-        if not self.is_valid_query(objects):
-            self.add_error(None, forms.ValidationError("Invalid Query", code="invalid-query"))
+        if self.prevalidate_query and not self.is_valid_query(objects):
+            self.add_invalid_query_error()
             return []
 
         # convert the search results to something that can be iterated over, and paged
-        return Pageable(objects, self.get_queryset())
+        pageable = Pageable(objects, self.get_queryset(), source_only=self.source_only)
+
+        if not self.prevalidate_query:
+            # the count is needed for pagination anyway, so running it now
+            # doubles as the query validation. Pageable remembers the count
+            try:
+                pageable.count()
+            except RequestError:
+                self.add_invalid_query_error()
+                return []
+
+        return pageable
+
+    async def aresults(self):
+        """
+        The asyncio version of results(). It returns an AsyncPageable instead
+        of a Pageable
+        """
+        if not self.in_search_mode():
+            return self.get_queryset()
+
+        # search() could hit the database (see SearchForm.search)
+        objects = await run_sync(self.search)
+
+        if not isinstance(objects, Search):
+            return objects
+
+        if self.prevalidate_query and not await self.ais_valid_query(objects):
+            self.add_invalid_query_error()
+            return []
+
+        pageable = AsyncPageable(objects, self.get_queryset(), source_only=self.source_only)
+
+        if not self.prevalidate_query:
+            try:
+                await pageable.acount()
+            except RequestError:
+                self.add_invalid_query_error()
+                return []
+
+        return pageable
 
 
 class SearchForm(BaseSearchForm):
@@ -147,6 +272,38 @@ class SearchForm(BaseSearchForm):
 
         return a_page
 
+    async def aresults(self, page, items_per_page=getattr(settings, "ITEMS_PER_PAGE", 100)):
+        """
+        The asyncio version of results()
+        """
+        objects = await super().aresults()
+
+        if isinstance(objects, AsyncPageable):
+            await objects.acount()
+
+        paginator = Paginator(objects, items_per_page)
+        # make sure the count is cached on the paginator without blocking
+        await run_sync(getattr, paginator, "count")
+        try:
+            number = paginator.validate_number(page)
+        except PageNotAnInteger:
+            number = 1
+        except EmptyPage:
+            number = paginator.num_pages
+
+        # this mirrors Paginator.page()
+        bottom = (number - 1) * paginator.per_page
+        top = bottom + paginator.per_page
+        if top + paginator.orphans >= paginator.count:
+            top = paginator.count
+
+        if isinstance(objects, AsyncPageable):
+            object_list = await objects.aget(slice(bottom, top))
+        else:
+            object_list = await run_sync(list, objects[bottom:top])
+
+        return Page(object_list, number, paginator)
+
 
 class Pageable:
     """
@@ -158,24 +315,58 @@ class Pageable:
     self.search with the PKs in self.queryset. If you didn't, then count()
     could include items that aren't in the queryset anymore (for example, if
     you deleted things from the database, but not from ES).
+
+    queryset can be None for a search across several indexes (see
+    IndexRegistry.search()), in which case each Index's get_queryset() is used.
+
+    If source_only is True, the items are SourceResult objects built from the
+    _source of the hits, and the database is only queried for the Index's
+    Meta.lazy_fields (when they're accessed).
     """
-    def __init__(self, search, queryset):
+    def __init__(self, search, queryset, source_only=False):
         self.search = search
         self.queryset = queryset
+        self.source_only = source_only
+        self._count = None
 
     def count(self):
-        return self.search.count()
+        # the Paginator and __iter__ both need the count, so only ask ES once
+        if self._count is None:
+            self._count = self.search.count()
+        return self._count
 
     def __iter__(self):
         return iter(self[0:self.count()])
 
     def __getitem__(self, key):
-        results = list(self.search[key].execute())
-        pk_to_model = dict((str(row.pk), row) for row in self.queryset.filter(pk__in=[result.meta.id for result in results]))
-        # we need to return the model objects in the order they were retrieved
-        # from ES
-        to_return = []
-        for result in results:
-            if result.meta.id in pk_to_model:
-                to_return.append(pk_to_model[result.meta.id])
-        return to_return
+        return self.hydrate(list(self.search[key].execute()))
+
+    def hydrate(self, results):
+        """
+        Convert the search hits to model objects (or SourceResults)
+        """
+        if self.source_only:
+            return source_results(results, self.queryset)
+
+        return hydrate(results, self.queryset)
+
+
+class AsyncPageable(Pageable):
+    """
+    A Pageable for asyncio code. Use `await acount()`, `await aget(key)` and
+    `async for` instead of count(), slicing and iterating. The hits are
+    turned into model objects in the event loop's executor, since the ORM
+    can't be used from a coroutine
+    """
+    async def acount(self):
+        if self._count is None:
+            self._count = await self.search.acount()
+        return self._count
+
+    async def aget(self, key):
+        results = list(await self.search[key].aexecute())
+        return await run_sync(self.hydrate, results)
+
+    async def __aiter__(self):
+        for item in await self.aget(slice(0, await self.acount())):
+            yield item
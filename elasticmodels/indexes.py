@@ -1,4 +1,9 @@
+import os
 import copy
+import json
+import datetime
+import hashlib
+from fnmatch import fnmatch
 from collections import defaultdict
 from contextlib import contextmanager
 from itertools import chain
@@ -6,13 +11,20 @@ import threading
 
 from six import add_metaclass
 from django.db import models
-from elasticsearch.helpers import bulk
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from elasticsearch.helpers import scan
 from elasticsearch_dsl.connections import connections
-from elasticsearch_dsl.document import DocTypeMeta
-from elasticsearch_dsl.field import Field
+from elasticsearch_dsl.document import DocTypeMeta, DocTypeOptions
+from elasticsearch_dsl.field import Field, Object
 from elasticsearch_dsl import DocType
 
-from .exceptions import RedeclaredFieldError, ModelFieldNotMappedError
+from .bulk import bulk
+from .connection import CompressedHttpConnection
+from .exceptions import RedeclaredFieldError, ModelFieldNotMappedError, InvalidPartitionError
+from .partitions import PARTITION_FORMATS, partition_suffix, partition_suffixes
+from .search import IndexSearch, SearchBatch, SourceResult, bump_generation, hydrate, source_results
 from .fields import (
     EMField,
     StringField,
@@ -28,6 +40,33 @@ from .fields import (
 # this allows us to queue up index updates (in a thread safe manner)
 local_storage = threading.local()
 
+# the key in the _meta of a mapping where the fingerprint is stored (see
+# Index.mapping_fingerprint())
+FINGERPRINT_KEY = "elasticmodels_fingerprint"
+
+# the key in the _meta of a mapping where the fingerprint of the analysis that
+# is known to be in the index is stored (see Index.analysis_fingerprint())
+ANALYSIS_FINGERPRINT_KEY = "elasticmodels_analysis_fingerprint"
+
+# the status of a bulk item that was ignored because of its external version
+VERSION_CONFLICT = 409
+
+# held while the mapping of an Index is built (see LazyDocTypeOptions)
+build_lock = threading.RLock()
+
+# the client settings each connection gets, unless ELASTICSEARCH_CONNECTIONS
+# says otherwise. The pool has room for a threaded web worker, or a command
+# with a scan and bulk requests going at once. The bulk requests are sized to
+# take about a second, but a busy cluster can take much longer than the
+# client's 10 second default, and every request we send can safely be retried.
+# Sniffing isn't turned on, since it replaces the hosts with the addresses the
+# nodes publish, which breaks clusters behind a proxy or load balancer
+CONNECTION_DEFAULTS = {
+    "maxsize": 25,
+    "timeout": 30,
+    "retry_on_timeout": True,
+}
+
 
 class IndexRegistry:
     """
@@ -38,20 +77,67 @@ class IndexRegistry:
     def __init__(self):
         self.model_to_indexes = defaultdict(set)
         self.connected = False
+        # the process the clients in `self.clients` were created in
+        self.pid = None
+        # the connections that have a client created in this process
+        self.clients = set()
+        # the kwargs each connection was configured with (without the
+        # index_name)
+        self.connection_kwargs = {}
+        # the index settings (like number_of_shards) from the "settings" key
+        # of each connection
+        self.index_settings = {}
 
     def register(self, model, index):
         """Register the model with the registry"""
         self.model_to_indexes[model].add(index)
-        if not self.connected:
-            connections.index_name = {}
-            from django.conf import settings
-            kwargs = {}
-            for name, params in settings.ELASTICSEARCH_CONNECTIONS.items():
-                params = copy.deepcopy(params)
-                kwargs[name] = params
-                connections.index_name[name] = params.pop("index_name")
-            connections.configure(**kwargs)
-            self.connected = True
+
+    def configure(self):
+        """
+        Read the connections from settings.ELASTICSEARCH_CONNECTIONS. This is
+        done the first time a connection is needed, not when the Index
+        classes are created, and no clients are created here
+        """
+        if self.connected:
+            return
+
+        connections.index_name = {}
+        kwargs = {}
+        for name, params in settings.ELASTICSEARCH_CONNECTIONS.items():
+            params = copy.deepcopy(params)
+            kwargs[name] = params
+            connections.index_name[name] = params.pop("index_name")
+            self.index_settings[name] = params.pop("settings", {})
+            # the serializer can be given as a dotted path to a class
+            if isinstance(params.get("serializer"), str):
+                params["serializer"] = import_string(params["serializer"])()
+            if params.pop("compress", False):
+                params.setdefault("connection_class", CompressedHttpConnection)
+            for key, value in CONNECTION_DEFAULTS.items():
+                params.setdefault(key, value)
+        connections.configure(**kwargs)
+        self.connection_kwargs = kwargs
+        self.connected = True
+
+    def get_connection(self, using="default"):
+        """
+        Returns the Elasticsearch client for the connection. The client is
+        created the first time it is used in each process, so a process that
+        was forked (by gunicorn, celery, or multiprocessing) never shares the
+        pooled sockets of its parent
+        """
+        self.configure()
+        pid = os.getpid()
+        if self.pid != pid:
+            self.pid = pid
+            self.clients = set()
+
+        if using not in self.clients and using in self.connection_kwargs:
+            # this replaces any client elasticsearch-dsl created in the parent
+            connections.create_connection(using, **self.connection_kwargs[using])
+            self.clients.add(using)
+
+        return connections.get_connection(using)
 
     def update(self, instance, **kwargs):
         """
@@ -71,6 +157,31 @@ class IndexRegistry:
     def get_indexes(self):
         return set(chain(*self.model_to_indexes.values()))
 
+    def search(self, *indexes):
+        """
+        Returns a search across all the indexes (which must use the same
+        connection), or every index on the default connection. Wrap it in a
+        Pageable with queryset=None, or pass the hits to hydrate(), to get model
+        objects back with one query per model
+        """
+        if not indexes:
+            indexes = list(self.indexes_for_connection("default"))
+
+        usings = set(index._doc_type.using for index in indexes)
+        if len(usings) != 1:
+            raise ValueError("All the indexes in a search must use the same connection")
+
+        # only cache the results if every index asked for it
+        timeouts = [index._doc_type.cache_timeout for index in indexes]
+        cache_timeout = None if None in timeouts else min(timeouts)
+
+        return IndexSearch(
+            using=usings.pop(),
+            index=sorted(set(index._doc_type.index for index in indexes)),
+            doc_type=dict((index._doc_type.name, index.from_es) for index in indexes),
+            cache_timeout=cache_timeout,
+        )
+
     def get_models(self):
         return self.model_to_indexes.keys()
 
@@ -140,14 +251,126 @@ class DocTypeProxy(object):
     def __init__(self, index):
         self.index = index
 
-    def filter(self, *args, **kwargs):
-        return self.index.search().filter(*args, **kwargs)
+    def filter(self, *args, routing=None, **kwargs):
+        return self.index.search(routing=routing).filter(*args, **kwargs)
 
-    def query(self, *args, **kwargs):
-        return self.index.search().query(*args, **kwargs)
+    def query(self, *args, routing=None, **kwargs):
+        return self.index.search(routing=routing).query(*args, **kwargs)
 
-    def all(self):
-        return self.index.search()
+    def all(self, start=None, end=None, routing=None):
+        """
+        Returns a search for everything in the index, or only the documents
+        with a Meta.date_field between start and end (inclusive). For a
+        partitioned Index, only the partitions in that range are searched.
+
+        If routing is given, only the shard(s) for that routing value (or
+        list of values) are searched
+        """
+        return self.index.search(start=start, end=end, routing=routing)
+
+    def scan(self, search=None, batch_size=500, queryset=None):
+        """
+        A generator of the model objects for every hit in the search (or
+        the whole index), in the order ES returns them. The hits are fetched
+        with the scroll API `batch_size` at a time, and each batch is turned
+        into model objects with one in_bulk query on `queryset` (which
+        defaults to get_queryset()), so memory use stays constant
+        """
+        search = search if search is not None else self.all()
+        queryset = queryset if queryset is not None else self.get_queryset()
+        model = self.index._doc_type.model
+
+        # we only need the ids. from and size don't make sense for a scroll
+        body = search.to_dict()
+        body.pop("from", None)
+        body.pop("size", None)
+        body["_source"] = False
+
+        hits = scan(
+            registry.get_connection(search._using),
+            query=body,
+            index=search._index,
+            doc_type=search._doc_type,
+            size=batch_size,
+            preserve_order=True,
+            **search._params
+        )
+
+        batch = []
+        for hit in chain(hits, [None]):
+            if hit is not None:
+                batch.append(model._meta.pk.to_python(hit['_id']))
+                if len(batch) < batch_size:
+                    continue
+
+            pk_to_model = queryset.in_bulk(batch) if batch else {}
+            for pk in batch:
+                if pk in pk_to_model:
+                    yield pk_to_model[pk]
+            batch = []
+
+    def mget(self, pks, source_only=False, queryset=None, **kwargs):
+        """
+        Returns the model objects (or SourceResults if source_only is True)
+        for the pks that are in the index, in the same order. This uses the
+        realtime multi GET API, so documents can be read right after they are
+        written, without waiting for (or forcing) a refresh
+        """
+        if source_only:
+            kwargs.setdefault("_source", True)
+        else:
+            # we only need the ids to load the models
+            kwargs.setdefault("_source", False)
+
+        ids = [str(pk) for pk in pks]
+        if self.index._doc_type.partition:
+            # the multi GET API can't look in every partition, so a search is
+            # used instead (which means the results aren't realtime)
+            search = self.index.search(routing=kwargs.get("routing")).filter("ids", values=ids)
+            response = search.extra(_source=kwargs["_source"])[:len(ids)].execute()
+            id_to_hit = dict((hit.meta.id, hit) for hit in response)
+            hits = [id_to_hit[id] for id in ids if id in id_to_hit]
+        else:
+            docs = self.index.es.mget(
+                index=self.index._doc_type.index,
+                doc_type=self.index._doc_type.mapping.doc_type,
+                body={"ids": ids},
+                realtime=True,
+                **kwargs
+            )["docs"]
+            hits = [self.index.from_es(doc) for doc in docs if doc.get("found")]
+
+        if source_only:
+            return source_results(hits, queryset)
+        return hydrate(hits, queryset if queryset is not None else self.index.get_queryset())
+
+    def get(self, pk, source_only=False, queryset=None, **kwargs):
+        """
+        Like mget() for a single pk. Raises the model's DoesNotExist exception
+        if the pk isn't in the index (or the queryset)
+        """
+        results = self.mget([pk], source_only=source_only, queryset=queryset, **kwargs)
+        if not results:
+            model = self.index._doc_type.model
+            raise model.DoesNotExist("%s with pk %r is not in the %s index" % (model.__name__, pk, self))
+        return results[0]
+
+    def batch(self):
+        """
+        Returns a SearchBatch, for sending several searches on this Index's
+        connection to ES in one request
+        """
+        return SearchBatch(self.index._doc_type.using)
+
+    async def aexecute(self, search=None):
+        """
+        Execute the search (or a search for everything) with the asyncio
+        client
+        """
+        return await (search if search is not None else self.all()).aexecute()
+
+    async def acount(self, search=None):
+        return await (search if search is not None else self.all()).acount()
 
     def __getattr__(self, key):
         return getattr(self.index, key)
@@ -156,6 +379,88 @@ class DocTypeProxy(object):
         return str(self.index._doc_type.name)
 
 
+def version_number(value):
+    """
+    Convert the value of a Meta.version_field to the integer ES expects.
+    Dates and datetimes become milliseconds since the epoch
+    """
+    if isinstance(value, datetime.datetime):
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.get_default_timezone())
+        return int(round(value.timestamp() * 1000))
+    if isinstance(value, datetime.date):
+        return int(datetime.datetime(value.year, value.month, value.day, tzinfo=timezone.utc).timestamp() * 1000)
+    return int(value)
+
+
+def fingerprint(data):
+    """
+    Returns a hash of the JSON serializable data
+    """
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf8")).hexdigest()
+
+
+def excluded_paths(fields, prefix=""):
+    """
+    Returns the dotted paths of the fields (including the properties of
+    object fields) that were declared with source=False
+    """
+    paths = []
+    for name, field in fields.items():
+        if isinstance(field, EMField) and not field._in_source:
+            paths.append(prefix + name)
+        elif isinstance(field, Object):
+            paths.extend(excluded_paths(field.properties.to_dict(), prefix + name + "."))
+    return paths
+
+
+class LazyDocTypeOptions(DocTypeOptions):
+    """
+    The _doc_type of an Index. The fields listed in Meta.fields are added to
+    the mapping the first time the mapping is used, instead of when the Index
+    class is created, so importing the Index classes stays cheap. The
+    elasticmodels system check builds every mapping, so mistakes are still
+    reported when the project starts
+    """
+    @property
+    def mapping(self):
+        self.build()
+        return self.__dict__['mapping']
+
+    @mapping.setter
+    def mapping(self, value):
+        self.__dict__['mapping'] = value
+
+    @property
+    def source_excludes(self):
+        self.build()
+        return self.__dict__['source_excludes']
+
+    @source_excludes.setter
+    def source_excludes(self, value):
+        self.__dict__['source_excludes'] = value
+
+    def build(self):
+        """
+        Run the pending builder (once, even with several threads)
+        """
+        if self.__dict__.get('_builder') is None:
+            return
+
+        with build_lock:
+            builder = self.__dict__.get('_builder')
+            # the builder uses the mapping itself, which brings us back here
+            if builder is None or self.__dict__.get('_building'):
+                return
+            self.__dict__['_building'] = True
+            try:
+                builder()
+                # if the builder fails, it is run again the next time
+                self.__dict__['_builder'] = None
+            finally:
+                self.__dict__['_building'] = False
+
+
 class EMDocTypeMeta(DocTypeMeta):
     def __new__(cls, name, bases, attrs):
         super_new = super(EMDocTypeMeta, cls).__new__
@@ -175,6 +480,18 @@ class EMDocTypeMeta(DocTypeMeta):
         model_field_names = getattr(attrs['Meta'], "fields", [])
         date_field = getattr(attrs['Meta'], "date_field", None)
         ignore_signals = getattr(attrs['Meta'], "ignore_signals", False)
+        cache_timeout = getattr(attrs['Meta'], "cache_timeout", None)
+        lazy_fields = getattr(attrs['Meta'], "lazy_fields", [])
+        partition = getattr(attrs['Meta'], "partition", None)
+        routing = getattr(attrs['Meta'], "routing", None)
+        source_excludes = getattr(attrs['Meta'], "source_excludes", [])
+        version_field = getattr(attrs['Meta'], "version_field", None)
+
+        if partition is not None:
+            if partition not in PARTITION_FORMATS:
+                raise InvalidPartitionError("Meta.partition on %s must be one of %s" % (name, ", ".join(sorted(PARTITION_FORMATS))))
+            if date_field is None:
+                raise InvalidPartitionError("%s must have a Meta.date_field to be partitioned" % name)
 
         cls = super_new(cls, name, bases, attrs)
 
@@ -182,30 +499,60 @@ class EMDocTypeMeta(DocTypeMeta):
         cls._doc_type.model = model
         cls._doc_type.date_field = date_field
         cls._doc_type.ignore_signals = ignore_signals
+        cls._doc_type.cache_timeout = cache_timeout
+        cls._doc_type.lazy_fields = frozenset(lazy_fields)
+        cls._doc_type.result_class = None
+        cls._doc_type.partition = partition
+        cls._doc_type.version_field = version_field
+        # the routing value is looked up on the instance like a field's attr
+        cls._doc_type.routing = EMField(attr=routing) if routing else None
 
         # to match Django's API for models, add a class attribute called
         # "objects" that exposes the query() and filter() methods
         cls.objects = DocTypeProxy(cls())
-        # Registering the index has the side effect of setting up the ES
-        # connections, which populates the index_name attribute on
-        # `connections`. That allows us to tack on the index name to the
-        # doc_type
+        # the connections aren't set up until they are used
         registry.register(model, cls.objects)
-        cls._doc_type.index = connections.index_name[cls._doc_type.using]
-
-        # create a lookup lookup table for the model fields, and then construct
-        # an elasticsearch field based on the type
-        fields = model._meta.fields
-        fields_lookup = dict((field.name, field) for field in fields)
-
-        # tack on all the fields that were listed in Meta.fields
+        cls._doc_type.index = settings.ELASTICSEARCH_CONNECTIONS[cls._doc_type.using]['index_name']
+        if partition is not None:
+            # the documents are split into indices named like
+            # <index_name>-<doc_type>-2015.04, and this pattern covers them all
+            cls._doc_type.index = ("%s-%s-*" % (cls._doc_type.index, cls._doc_type.name)).lower()
+
+        # this field name is already in use (this is cheap, so it isn't
+        # deferred)
         for field_name in model_field_names:
-            # this field name is already in use
             if field_name in class_fields:
                 raise RedeclaredFieldError("You cannot redeclare the field named '%s' on %s" % (field_name, cls.__name__))
 
-            field_instance = cls.objects.to_field(field_name, fields_lookup[field_name])
-            cls._doc_type.mapping.field(field_name, field_instance)
+        def build():
+            mapping = cls._doc_type.mapping
+            # create a lookup lookup table for the model fields, and then construct
+            # an elasticsearch field based on the type
+            fields = model._meta.fields
+            fields_lookup = dict((field.name, field) for field in fields)
+
+            # tack on all the fields that were listed in Meta.fields
+            for field_name in model_field_names:
+                if field_name not in fields_lookup:
+                    raise ModelFieldNotMappedError("%s has no field named '%s' for %s" % (model.__name__, field_name, cls.__name__))
+                field_instance = cls.objects.to_field(field_name, fields_lookup[field_name])
+                mapping.field(field_name, field_instance)
+
+            if routing:
+                # make ES reject writes that are missing the routing value, since
+                # they would end up on the wrong shard
+                mapping.meta('_routing', required=True)
+
+            # leave the fields with source=False (and the Meta.source_excludes
+            # paths) out of the _source ES keeps
+            excludes = sorted(set(source_excludes) | set(excluded_paths(cls._doc_type._fields())))
+            cls._doc_type.source_excludes = tuple(excludes)
+            if excludes:
+                mapping.meta('_source', excludes=excludes)
+
+        # the mapping is built the first time it is used
+        cls._doc_type.__class__ = LazyDocTypeOptions
+        cls._doc_type.__dict__['_builder'] = build
 
         # provide a shortcut to get the fields on the Index, since accessing
         # them is so convoluted
@@ -225,7 +572,86 @@ class Index(DocType):
 
     @property
     def es(self):
-        return connections.get_connection(self._doc_type.using)
+        return registry.get_connection(self._doc_type.using)
+
+    @classmethod
+    def search(cls, using=None, index=None, start=None, end=None, routing=None):
+        """
+        Returns a search on the index. If start or end are given, the search
+        is limited to the documents with a Meta.date_field in that range, and
+        for a partitioned Index, to the partitions for that range. If routing
+        is given, only the shards for the routing value(s) are searched
+        """
+        # writes bump the generation of the Index's own index and doc_type
+        # (see bulk()), so the cached results depend on that, whatever index
+        # is searched
+        generations = [(cls._doc_type.index, cls._doc_type.name)]
+        if start is None and end is None:
+            search = IndexSearch(
+                using=using or cls._doc_type.using,
+                index=index or cls._doc_type.index,
+                doc_type={cls._doc_type.name: cls.from_es},
+                cache_timeout=cls._doc_type.cache_timeout,
+                generations=generations,
+            )
+            return cls.route(search, routing)
+
+        date_field = cls._doc_type.date_field
+        if date_field is None:
+            raise ValueError("%s can't be searched by date without a Meta.date_field" % cls.__name__)
+
+        if index is None and cls._doc_type.partition:
+            # if none of the partitions exist, the pattern is used, and the
+            # range filter does the work
+            index = cls.objects.partitions(start, end) or None
+
+        date_range = {}
+        if start is not None:
+            date_range["gte"] = start
+        if end is not None:
+            date_range["lte"] = end
+
+        search = IndexSearch(
+            using=using or cls._doc_type.using,
+            index=index or cls._doc_type.index,
+            doc_type={cls._doc_type.name: cls.from_es},
+            cache_timeout=cls._doc_type.cache_timeout,
+            generations=generations,
+        )
+        # partitions that don't exist yet are skipped instead of being an error
+        search = search.filter("range", **{date_field: date_range}).params(ignore_unavailable=True)
+        return cls.route(search, routing)
+
+    @staticmethod
+    def route(search, routing):
+        """
+        Returns the search limited to the routing value, or list of values
+        """
+        if routing is None:
+            return search
+        if isinstance(routing, (list, tuple, set)):
+            routing = ",".join(str(value) for value in routing)
+        return search.params(routing=str(routing))
+
+    @classmethod
+    def result_class(cls):
+        """
+        Returns the SourceResult subclass used to represent hits from this
+        Index without touching the database
+        """
+        if cls._doc_type.result_class is None:
+            field_names = tuple(
+                name for name in cls._doc_type._fields()
+                if name.isidentifier() and not hasattr(SourceResult, name) and
+                # these aren't in the _source
+                not any(fnmatch(name, pattern) for pattern in cls._doc_type.source_excludes)
+            )
+            cls._doc_type.result_class = type(cls.__name__ + "Result", (SourceResult,), {
+                "__slots__": field_names,
+                "field_names": field_names,
+                "lazy_fields": cls._doc_type.lazy_fields - set(field_names),
+            })
+        return cls._doc_type.result_class
 
     def get_queryset(self, start=None, end=None):
         """
@@ -281,11 +707,26 @@ class Index(DocType):
             raise ModelFieldNotMappedError("Cannot convert model field %s to an Elasticsearch field!" % field_name)
 
     def bulk(self, actions, refresh=True, **kwargs):
-        return bulk(client=self.es, actions=actions, refresh=refresh, **kwargs)
-
-    def update(self, thing, refresh=True, action="index", **kwargs):
         """
-        Update each document in ES for a model, iterable of models or queryset
+        Send the actions to ES with the AdaptiveBulkSender. kwargs can
+        include a dead_letter path for the actions that fail
+        """
+        if self._doc_type.version_field is not None:
+            # a version conflict just means ES already has a document at
+            # least as new as this one
+            kwargs.setdefault("ignore_status", (VERSION_CONFLICT,))
+        result = bulk(client=self.es, actions=actions, refresh=refresh, **kwargs)
+        # orphan the cached search results for this index. This is done even
+        # without a Meta.cache_timeout, since any search can be cached with
+        # IndexSearch.cache()
+        bump_generation(self._doc_type.index, self._doc_type.mapping.doc_type)
+        return result
+
+    def update(self, thing, refresh=True, action="index", index=None, **kwargs):
+        """
+        Update each document in ES for a model, iterable of models or queryset.
+        The documents are written to `index` if it is given, instead of the
+        index_name of the connection
         """
         # thing can be a model object, or an iterable of models
         kwargs['refresh'] = refresh
@@ -294,15 +735,7 @@ class Index(DocType):
         if isinstance(thing, models.Model):
             thing = [thing]
 
-        operations = [{
-            '_op_type': action,
-            '_index': self._doc_type.index,
-            '_type': self._doc_type.mapping.doc_type,
-            '_id': model.pk,
-            # we don't do all the work of preparing a model when we're deleting
-            # it
-            '_source': self.prepare(model) if action != "delete" else None,
-        } for model in thing]
+        operations = [self.operation(model, action, index) for model in thing]
 
         # if running in the suspended_updates context, we just save the thing
         # for later
@@ -314,28 +747,238 @@ class Index(DocType):
             # to avoid special cases, we just always use the bulk API
             return self.bulk(operations, **kwargs)
 
+    def operation(self, instance, action="index", index=None):
+        """
+        Returns the bulk operation for the model instance
+        """
+        operation = {
+            '_op_type': action,
+            '_index': index or self.index_for(instance),
+            '_type': self._doc_type.mapping.doc_type,
+            '_id': instance.pk,
+            # we don't do all the work of preparing a model when we're deleting
+            # it
+            '_source': self.prepare(instance) if action != "delete" else None,
+        }
+        if self._doc_type.routing is not None:
+            operation['_routing'] = self.get_routing(instance)
+        if self._doc_type.version_field is not None:
+            # ES ignores the write if it has a newer version of the document
+            operation['_version'] = version_number(getattr(instance, self._doc_type.version_field))
+            operation['_version_type'] = "external_gte"
+        return operation
+
+    def get_routing(self, instance):
+        """
+        Returns the routing value for the model instance, from the Meta.routing
+        attribute path
+        """
+        value = self._doc_type.routing.get_from_instance(instance)
+        if value is None:
+            raise ValueError("The %s routing value for %r is None" % (self.__class__.__name__, instance))
+        return str(value)
+
     def delete(self, thing, **kwargs):
         """
         Delete the thing from ES
         """
         self.update(thing, action="delete", **kwargs)
 
-    def put_mapping(self):
+    def delete_pks(self, pks, **kwargs):
+        """
+        Delete the documents for the pks from ES. Unlike delete(), this doesn't
+        need the model objects (which might not exist anymore)
+        """
+        if self._doc_type.partition or self._doc_type.routing is not None:
+            # the partition and routing can't be worked out without the model
+            # object, so ask ES where each document is
+            hits = scan(
+                self.es,
+                # the routing isn't returned unless it is asked for
+                query={"query": {"ids": {"values": [str(pk) for pk in pks]}}, "fields": ["_routing"], "_source": False},
+                index=self._doc_type.index,
+                doc_type=self._doc_type.mapping.doc_type,
+            )
+            locations = [
+                (hit['_id'], hit['_index'], hit.get('fields', {}).get('_routing', hit.get('_routing')))
+                for hit in hits
+            ]
+        else:
+            locations = [(pk, self._doc_type.index, None) for pk in pks]
+
+        operations = []
+        for pk, index, routing in locations:
+            operation = {
+                '_op_type': 'delete',
+                '_index': index,
+                '_type': self._doc_type.mapping.doc_type,
+                '_id': pk,
+            }
+            if routing is not None:
+                operation['_routing'] = routing
+            operations.append(operation)
+
+        return self.bulk(operations, **kwargs)
+
+    def partition_index(self, value):
+        """
+        Returns the name of the partition for the date or datetime
+        """
+        return self._doc_type.index.replace("*", partition_suffix(value, self._doc_type.partition))
+
+    def index_for(self, instance):
+        """
+        Returns the name of the index the model instance's document belongs in
+        """
+        if self._doc_type.partition:
+            return self.partition_index(getattr(instance, self._doc_type.date_field))
+        return self._doc_type.index
+
+    def existing_partitions(self):
+        """
+        Returns the sorted names of the partitions that exist in ES
+        """
+        response = self.es.indices.get_alias(index=self._doc_type.index, ignore=[404])
+        return sorted(name for name in response if fnmatch(name, self._doc_type.index))
+
+    def partitions(self, start=None, end=None):
+        """
+        Returns the names of the partitions that cover start to end
+        (inclusive). If either end is open, only the partitions that exist are
+        returned
+        """
+        if start is not None and end is not None:
+            suffixes = partition_suffixes(start, end, self._doc_type.partition)
+            return [self._doc_type.index.replace("*", suffix) for suffix in suffixes]
+
+        return [
+            name for name in self.existing_partitions()
+            if (start is None or name >= self.partition_index(start)) and
+            (end is None or name <= self.partition_index(end))
+        ]
+
+    def drop_partitions(self, before):
+        """
+        Delete the partitions for the periods entirely before the date or
+        datetime. Returns the names of the deleted partitions
+        """
+        dropped = [name for name in self.existing_partitions() if name < self.partition_index(before)]
+        for name in dropped:
+            self.es.indices.delete(index=name)
+        if dropped:
+            bump_generation(self._doc_type.index, self._doc_type.mapping.doc_type)
+        return dropped
+
+    def mapping_fingerprint(self):
+        """
+        Returns a hash of the mapping. It is stored in the _meta of the
+        mapping in ES, so we can tell when the mapping needs to be put again
+        """
+        return fingerprint(self._doc_type.mapping.to_dict())
+
+    def analysis_fingerprint(self):
+        """
+        Returns a hash of the analysis for the connection. put_mapping() can't
+        change the analysis of an existing index, so this is only stored in ES
+        when the analysis is known to be in the index
+        """
+        return fingerprint(collect_analysis(self._doc_type.using))
+
+    def existing_meta(self, index=None):
+        """
+        Returns the _meta of the mapping in ES (which is empty if there is no
+        mapping)
+        """
+        doc_type = self._doc_type.mapping.doc_type
+        response = self.es.indices.get_mapping(index=index or self._doc_type.index, doc_type=doc_type, ignore=[404])
+        for index_mappings in response.values():
+            if not isinstance(index_mappings, dict):
+                continue
+            return index_mappings.get('mappings', {}).get(doc_type, {}).get('_meta', {})
+        return {}
+
+    def existing_fingerprint(self, index=None):
+        """
+        Returns the fingerprint stored in the mapping in ES, or None
+        """
+        return self.existing_meta(index).get(FINGERPRINT_KEY)
+
+    def mapping_is_current(self, index=None):
+        """
+        Returns True if the mapping in ES matches the one defined in Python
+        land
+        """
+        return self.existing_fingerprint(index) == self.mapping_fingerprint()
+
+    def analysis_is_current(self, index=None):
         """
-        Create the index and mapping in ES
+        Returns True if the analysis defined in Python land is known to be in
+        the index
         """
-        index_name = self._doc_type.index
+        return self.existing_meta(index).get(ANALYSIS_FINGERPRINT_KEY) == self.analysis_fingerprint()
 
-        if not self.es.indices.exists(index=index_name):
-            analysis = collect_analysis(self._doc_type.using)
-            self.es.indices.create(index=index_name, body={'settings': {'analysis': analysis}})
+    def put_mapping(self, index=None, analysis_applied=False):
+        """
+        Create the index and mapping in ES. If `index` is given, the mapping
+        is put in that index instead of the index_name of the connection.
+        Nothing is done if the mapping in ES is already current.
+
+        Pass analysis_applied=True if the index is known to have the analysis
+        defined in Python land (because it was just created or updated), so it
+        is recorded in the mapping
+        """
+        index_name = index or self._doc_type.index
+        doc_type = self._doc_type.mapping.doc_type
+        mapping_fingerprint = self.mapping_fingerprint()
+        partitioned = index is None and self._doc_type.partition
+
+        # this is a single request, so it's cheap to run on every update_index
+        existing = self.existing_meta(index_name)
+        analysis_fingerprint = self.analysis_fingerprint() if analysis_applied else existing.get(ANALYSIS_FINGERPRINT_KEY)
+        if existing.get(FINGERPRINT_KEY) == mapping_fingerprint and existing.get(ANALYSIS_FINGERPRINT_KEY) == analysis_fingerprint:
+            return None
+
+        using = self._doc_type.using
+        index_settings = {'analysis': collect_analysis(using)}
+        if registry.index_settings.get(using):
+            index_settings['index'] = registry.index_settings[using]
+
+        if partitioned:
+            # the partitions are created by ES the first time a document is
+            # written to them, so the template makes sure they get the
+            # settings and mapping
+            self.es.indices.put_template(name=self.partition_template_name(), body={
+                'template': self._doc_type.index,
+                'settings': index_settings,
+                'mappings': self.mapping_body(mapping_fingerprint),
+            })
+            if not self.existing_partitions():
+                return None
+        elif not self.es.indices.exists(index=index_name):
+            self.es.indices.create(index=index_name, body={'settings': index_settings})
+            analysis_fingerprint = self.analysis_fingerprint()
 
         return self.es.indices.put_mapping(
             index=index_name,
-            doc_type=self._doc_type.mapping.doc_type,
-            body=self._doc_type.mapping.to_dict()
+            doc_type=doc_type,
+            body=self.mapping_body(mapping_fingerprint, analysis_fingerprint),
         )
 
+    def mapping_body(self, mapping_fingerprint, analysis_fingerprint=None):
+        """
+        Returns the mapping, with the fingerprints in its _meta
+        """
+        doc_type = self._doc_type.mapping.doc_type
+        body = self._doc_type.mapping.to_dict()
+        meta = {FINGERPRINT_KEY: mapping_fingerprint}
+        if analysis_fingerprint is not None:
+            meta[ANALYSIS_FINGERPRINT_KEY] = analysis_fingerprint
+        body[doc_type]['_meta'] = dict(body[doc_type].get('_meta', {}), **meta)
+        return body
+
+    def partition_template_name(self):
+        return self._doc_type.index.replace("*", "template")
+
     def delete_mapping(self):
         return self.es.indices.delete_mapping(index=self._doc_type.index, doc_type=self._doc_type.mapping.doc_type, ignore=[404])
 
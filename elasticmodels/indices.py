@@ -0,0 +1,269 @@
+import copy
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils import timezone
+
+from elasticsearch.helpers import scan
+
+from .analysis import collect_analysis, compare_dicts
+from .bulk import bulk
+from .indexes import VERSION_CONFLICT, registry
+
+# the settings a new index is created with while it is being populated
+BULK_LOAD_SETTINGS = {
+    "refresh_interval": "-1",
+    "number_of_replicas": 0,
+}
+
+# the settings used on an existing index during update_index --bulk-mode. The
+# translog durability can't be relaxed, since ES 1.x has no dynamic setting
+# for it
+BULK_MODE_SETTINGS = dict(BULK_LOAD_SETTINGS)
+
+# what the settings above are restored to if there isn't an existing value to
+# copy (these are the ES defaults)
+DEFAULT_SETTINGS = {
+    "refresh_interval": "1s",
+    "number_of_replicas": 1,
+}
+
+# how long to wait for the force merge at the end of a bulk load. A merge of a
+# big index takes far longer than the client's default timeout
+MERGE_TIMEOUT = 60 * 60
+
+# the settings that can't be changed on an existing index
+STATIC_SETTINGS = frozenset([
+    "number_of_shards",
+    "number_of_routing_shards",
+    "routing_partition_size",
+    "codec",
+    "shard.check_on_startup",
+])
+
+
+def get_index_name(using):
+    return settings.ELASTICSEARCH_CONNECTIONS[using]['index_name']
+
+
+def new_index_name(using):
+    """
+    Returns a new timestamped name for a physical index for the connection
+    """
+    return "%s_%s" % (get_index_name(using), timezone.now().strftime("%Y%m%d%H%M%S%f"))
+
+
+def physical_indices(using):
+    """
+    Returns the names of the physical indices behind the connection's
+    index_name
+    """
+    es = registry.get_connection(using)
+    index_name = get_index_name(using)
+    if es.indices.exists_alias(name=index_name):
+        return sorted(es.indices.get_alias(name=index_name).keys())
+    if es.indices.exists(index=index_name):
+        return [index_name]
+    return []
+
+
+def get_index_settings(using, index):
+    """
+    Returns the "index" settings for the physical index, with flattened keys
+    like "translog.flush_threshold_size"
+    """
+    es = registry.get_connection(using)
+    response = es.indices.get_settings(index=index, flat_settings=True)
+    flat = next(iter(response.values()))['settings']
+    return dict((key[len("index."):], value) for key, value in flat.items() if key.startswith("index."))
+
+
+def configured_settings(using):
+    """
+    Returns the index settings from the "settings" key of the connection in
+    ELASTICSEARCH_CONNECTIONS
+    """
+    return registry.index_settings.get(using, {})
+
+
+def setting_string(value):
+    """
+    Returns the value the way ES returns it from get_settings
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return None if value is None else str(value)
+
+
+def changed_settings(using, index):
+    """
+    Returns a two-tuple of dicts of the configured settings that differ from
+    the settings on the physical index. The first has the dynamic settings,
+    the second has the static settings (which need a rebuild to change)
+    """
+    existing = get_index_settings(using, index)
+    dynamic, static = {}, {}
+    for key, value in configured_settings(using).items():
+        if setting_string(existing.get(key)) != setting_string(value):
+            (static if key in STATIC_SETTINGS else dynamic)[key] = value
+    return dynamic, static
+
+
+def diff_settings(using, index, keys):
+    """
+    Returns a diff string comparing the settings on the physical index with
+    the configured settings, limited to `keys`
+    """
+    existing = get_index_settings(using, index)
+    configured = configured_settings(using)
+    return compare_dicts(
+        dict((key, setting_string(existing.get(key))) for key in keys),
+        dict((key, setting_string(configured[key])) for key in keys),
+    )
+
+
+def current_settings(using, index, keys):
+    """
+    Returns the values of the setting keys for the index, falling back on
+    DEFAULT_SETTINGS for any that aren't set
+    """
+    existing = get_index_settings(using, index)
+    return dict((key, existing.get(key, DEFAULT_SETTINGS.get(key))) for key in keys)
+
+
+def create_index(using, index, extra_settings=None):
+    """
+    Create the physical index with the analysis from Python land, and put the
+    mappings for all the (unpartitioned) Index classes on the connection
+    """
+    es = registry.get_connection(using)
+    body = {'settings': {'analysis': collect_analysis(using)}}
+    extra_settings = copy.deepcopy(extra_settings or {})
+    # the extra "index" settings take precedence over the configured ones
+    index_settings = dict(configured_settings(using), **extra_settings.pop('index', {}))
+    if index_settings:
+        body['settings']['index'] = index_settings
+    body['settings'].update(extra_settings)
+    es.indices.create(index=index, body=body)
+
+    for doc_type_index in registry.indexes_for_connection(using):
+        # partitioned Indexes have their own indices
+        if not doc_type_index._doc_type.partition:
+            doc_type_index.put_mapping(index=index, analysis_applied=True)
+
+
+def copy_from_source(using, index, chunk_size=500):
+    """
+    Copy every document behind the connection's index_name into the physical
+    index, using the _source of each document. The documents are read with a
+    scan, and written with the bulk API (keeping their routing, and their
+    version if any Index on the connection has a Meta.version_field), so the
+    database isn't touched.
+
+    Returns a two-tuple of the number of documents copied, and the list of
+    errors
+    """
+    es = registry.get_connection(using)
+    # the external versions have to survive the copy, or a stale write would
+    # beat the copied document
+    versioned = any(doc_type_index._doc_type.version_field is not None for doc_type_index in registry.indexes_for_connection(using))
+    hits = scan(
+        es,
+        query={"query": {"match_all": {}}, "fields": ["_source", "_routing"], "version": versioned},
+        index=get_index_name(using),
+        size=chunk_size,
+    )
+
+    def actions():
+        for hit in hits:
+            action = {
+                '_op_type': 'index',
+                '_index': index,
+                '_type': hit['_type'],
+                '_id': hit['_id'],
+                '_source': hit['_source'],
+            }
+            routing = hit.get('fields', {}).get('_routing', hit.get('_routing'))
+            if routing is not None:
+                action['_routing'] = routing
+            if versioned:
+                action['_version'] = hit['_version']
+                action['_version_type'] = "external"
+            yield action
+
+    bulk_kwargs = {"ignore_status": (VERSION_CONFLICT,)} if versioned else {}
+    return bulk(es, actions(), chunk_size=chunk_size, raise_on_error=False, **bulk_kwargs)
+
+
+def finish_bulk_load(using, index, restore_from=None):
+    """
+    Undo the BULK_LOAD_SETTINGS on the index, by using the configured
+    settings, or copying the values from the `restore_from` index (or using
+    the ES defaults), then force merge and refresh it
+    """
+    es = registry.get_connection(using)
+    if restore_from:
+        restored = current_settings(using, restore_from, BULK_LOAD_SETTINGS)
+    else:
+        restored = dict((key, DEFAULT_SETTINGS[key]) for key in BULK_LOAD_SETTINGS)
+    configured = configured_settings(using)
+    restored.update((key, configured[key]) for key in BULK_LOAD_SETTINGS if key in configured)
+
+    es.indices.put_settings(index=index, body={'index': restored})
+    # optimize is what the client calls the force merge API
+    es.indices.optimize(index=index, request_timeout=MERGE_TIMEOUT)
+    es.indices.refresh(index=index)
+
+
+def swap_alias(using, index, delete_old=False):
+    """
+    Atomically point the connection's index_name alias at the physical index.
+    If the index_name is a concrete index (it was created before aliases were
+    used), it has to be deleted first, so delete_old must be True.
+
+    Returns the list of the physical indices the alias used to point at
+    """
+    es = registry.get_connection(using)
+    alias = get_index_name(using)
+    old = [name for name in physical_indices(using) if name != index]
+
+    if old == [alias]:
+        if not delete_old:
+            raise ValueError(
+                "%s is an index, not an alias. It must be deleted before the alias can be created" % alias
+            )
+        es.indices.delete(index=alias)
+        es.indices.put_alias(index=index, name=alias)
+        return old
+
+    actions = [{'remove': {'index': name, 'alias': alias}} for name in old]
+    actions.append({'add': {'index': index, 'alias': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+
+    if delete_old:
+        for name in old:
+            es.indices.delete(index=name)
+
+    return old
+
+
+@contextmanager
+def bulk_mode(using):
+    """
+    Apply the BULK_MODE_SETTINGS to the connection's indices for the duration
+    of the with block. The previous settings are restored afterwards (even if
+    there is an error or a KeyboardInterrupt), and the indices are refreshed
+    """
+    es = registry.get_connection(using)
+    previous = dict(
+        (index, current_settings(using, index, BULK_MODE_SETTINGS))
+        for index in physical_indices(using)
+    )
+    try:
+        for index in previous:
+            es.indices.put_settings(index=index, body={'index': BULK_MODE_SETTINGS})
+        yield
+    finally:
+        for index, index_settings in previous.items():
+            es.indices.put_settings(index=index, body={'index': index_settings})
+            es.indices.refresh(index=index)
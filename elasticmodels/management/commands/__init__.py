@@ -1,3 +1,6 @@
+import os
+import json
+
 from ...indexes import registry
 
 def get_models(args):
@@ -24,3 +27,70 @@ def get_models(args):
         models = registry.get_models()
 
     return set(models)
+
+
+def keyset_chunks(qs, chunk_size, after=None):
+    """
+    Generate lists of up to chunk_size objects from the queryset, ordered by
+    pk, starting after the `after` pk. Each chunk is fetched with its own
+    query (WHERE pk > last_pk ORDER BY pk LIMIT chunk_size), so no long running
+    cursor is held open
+    """
+    qs = qs.order_by("pk")
+    while True:
+        chunk_qs = qs.filter(pk__gt=after) if after is not None else qs
+        chunk = list(chunk_qs[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1].pk
+
+
+def keyset_pks(qs, chunk_size):
+    """
+    Generate every pk in the queryset in order, fetching chunk_size of them
+    per query
+    """
+    qs = qs.order_by("pk").values_list("pk", flat=True)
+    after = None
+    while True:
+        chunk = list((qs.filter(pk__gt=after) if after is not None else qs)[:chunk_size])
+        if not chunk:
+            return
+        for pk in chunk:
+            yield pk
+        after = chunk[-1]
+
+
+def load_state(path):
+    """
+    Load the JSON state file the management commands use to remember their
+    progress. A missing file is the empty state
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(path, state):
+    """
+    Atomically replace the state file (or remove it, if the state is empty)
+    """
+    if not state:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def state_key(index):
+    """
+    The key for an Index in the state files
+    """
+    return "%s:%s" % (index._doc_type.using, index._doc_type.mapping.doc_type)
@@ -1,24 +1,74 @@
 from optparse import make_option
+from django.utils import timezone
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.conf import settings
-from elasticsearch_dsl.connections import connections
 
 from ...analysis import combined_analysis, is_analysis_compatible, diff_analysis
+from ...indexes import registry
+from ...indices import (
+    BULK_LOAD_SETTINGS,
+    get_index_name,
+    new_index_name,
+    physical_indices,
+    changed_settings,
+    diff_settings,
+    create_index,
+    copy_from_source,
+    finish_bulk_load,
+    swap_alias,
+)
+from . import keyset_chunks
 from .clear_index import Command as ClearIndexCommand
 
 class Command(ClearIndexCommand):
     option_list = ClearIndexCommand.option_list + (
         make_option('--clopen', action="store_true", default='', dest='clopen'),
+        make_option('--swap', action="store_true", default='', dest='swap',
+                    help="Build a new index behind the scenes, and then atomically point the index_name alias at it"),
+        make_option('--delete-old', action="store_true", default='', dest='delete_old',
+                    help="With --swap, delete the old index after the alias is moved"),
+        make_option('--from-source', action="store_true", default='', dest='from_source',
+                    help="With --swap, copy the _source of the documents from the old index instead of reading the database"),
+        make_option('--chunk-size', action="store", type="int", default=1000, dest='chunk_size',
+                    help="The number of objects to fetch from the database (in pk order) and index at a time"),
     )
 
     def handle(self, *args, **options):
         usings = options.get("using") or settings.ELASTICSEARCH_CONNECTIONS.keys()
 
+        if options.get("swap"):
+            if args:
+                raise CommandError("--swap rebuilds every index on the connection, so it can't be limited to models or apps")
+
+            for using in usings:
+                self.swap(
+                    using,
+                    delete_old=options.get("delete_old"),
+                    from_source=options.get("from_source"),
+                    chunk_size=options.get("chunk_size") or 1000,
+                )
+            return
+
+        if options.get("from_source"):
+            raise CommandError("--from-source can only be used with --swap")
+
+        # the connections where the analysis in ES is compatible (or was made
+        # compatible with --clopen)
+        checked = []
         for using in usings:
+            self.update_settings(using)
+
+            # if the analysis is known to be in the index, there is no need to
+            # fetch and compare the analysis settings
+            indexes = [index for index in registry.indexes_for_connection(using) if not index._doc_type.partition]
+            if all(index.analysis_is_current() for index in indexes):
+                continue
+
             # figure out if there is a conflict with the analysis defined in ES
             # and the analysis defined in Python land for this connection
             index_name = settings.ELASTICSEARCH_CONNECTIONS[using]['index_name']
-            es = connections.get_connection(using)
+            es = registry.get_connection(using)
             result = is_analysis_compatible(using)
             if result is False:
                 if options.get("clopen"):
@@ -36,7 +86,96 @@ class Command(ClearIndexCommand):
                     )
                     self.stderr.write(diff_analysis(using))
                     exit(1)
+            checked.append(using)
 
         super().handle(*args, **options)
         if self.confirmed:
             call_command("update_index", *args, **options)
+
+            # record that the analysis is in the index, so the next run can
+            # skip the check
+            for using in checked:
+                for index in registry.indexes_for_connection(using):
+                    if not index._doc_type.partition:
+                        index.put_mapping(analysis_applied=True)
+
+    def update_settings(self, using):
+        """
+        Apply the configured dynamic index settings that differ from the ones
+        in ES, and warn about the static settings that differ
+        """
+        es = registry.get_connection(using)
+        for index_name in physical_indices(using):
+            dynamic, static = changed_settings(using, index_name)
+            if dynamic:
+                self.stdout.write("Updating the %s settings of %s" % (", ".join(sorted(dynamic)), index_name))
+                es.indices.put_settings(index=index_name, body={'index': dynamic})
+            if static:
+                self.stderr.write(
+                    "The %s settings of %s can't be changed on an existing index. "
+                    "Use --swap to rebuild it with the new settings." % (", ".join(sorted(static)), index_name)
+                )
+                self.stderr.write(diff_settings(using, index_name, static))
+
+    def swap(self, using, delete_old=False, from_source=False, chunk_size=1000):
+        """
+        Populate a new physical index for the connection (with refreshes and
+        replicas turned off), and then move the alias to it. Searches keep
+        using the old index until the alias is moved.
+
+        If from_source is True, the documents are copied from the old index,
+        instead of being built from the database. That only works when the
+        mappings changed, but the documents themselves did not
+        """
+        old = physical_indices(using)
+        if from_source and not old:
+            raise CommandError("There is no existing index to copy the documents from")
+
+        # find out now, not after the load, that the alias can't be created
+        if old == [get_index_name(using)] and not delete_old:
+            raise CommandError(
+                "%s is an index, not an alias. It must be deleted before the alias can be created. "
+                "Use --delete-old to delete it." % old[0]
+            )
+
+        if from_source:
+            excluding = [str(index) for index in registry.indexes_for_connection(using) if index._doc_type.source_excludes]
+            if excluding:
+                raise CommandError(
+                    "--from-source can't be used, since %s leave fields out of the _source" % ", ".join(sorted(excluding))
+                )
+
+        index_name = new_index_name(using)
+        self.stdout.write("Creating %s" % index_name)
+        create_index(using, index_name, extra_settings={'index': BULK_LOAD_SETTINGS})
+        load_started = timezone.now()
+
+        if from_source:
+            self.stdout.write("Copying the documents from %s" % ", ".join(old))
+            copied, errors = copy_from_source(using, index_name)
+            if errors:
+                raise CommandError("%d documents could not be copied to %s: %s" % (len(errors), index_name, errors[0]))
+            self.stdout.write("Copied %d documents" % copied)
+        else:
+            for index in registry.indexes_for_connection(using):
+                if index._doc_type.partition:
+                    continue
+                qs = index.get_queryset()
+                self.stdout.write("Indexing %d %s objects" % (qs.count(), index._doc_type.model.__name__))
+                for chunk in keyset_chunks(qs, chunk_size):
+                    index.update(chunk, index=index_name, refresh=False)
+
+        self.stdout.write("Optimizing %s" % index_name)
+        finish_bulk_load(using, index_name, restore_from=old[-1] if old else None)
+
+        if not from_source:
+            # the objects saved during the load were only written to the old
+            # index, so index them again (this needs a Meta.date_field)
+            for index in registry.indexes_for_connection(using):
+                if index._doc_type.partition or not index._doc_type.date_field:
+                    continue
+                for chunk in keyset_chunks(index.get_queryset(start=load_started), chunk_size):
+                    index.update(chunk, index=index_name)
+
+        swap_alias(using, index_name, delete_old=delete_old)
+        self.stdout.write("%s now points at %s" % (get_index_name(using), index_name))
@@ -0,0 +1,136 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from elasticsearch.helpers import scan
+
+from ...indexes import registry
+from . import get_models, keyset_pks
+
+
+def merge_join(es_pks, db_pks):
+    """
+    Merge two sorted streams of pks, generating (pk, in_es, in_db) tuples.
+    Raises a ValueError if either stream isn't sorted, since the result would
+    be garbage
+    """
+    es_pks = iter(es_pks)
+    db_pks = iter(db_pks)
+    es_pk = next(es_pks, None)
+    db_pk = next(db_pks, None)
+    last = None
+    while es_pk is not None or db_pk is not None:
+        if db_pk is None or (es_pk is not None and es_pk < db_pk):
+            pk, in_es, in_db = es_pk, True, False
+            es_pk = next(es_pks, None)
+        elif es_pk is None or db_pk < es_pk:
+            pk, in_es, in_db = db_pk, False, True
+            db_pk = next(db_pks, None)
+        else:
+            pk, in_es, in_db = es_pk, True, True
+            es_pk = next(es_pks, None)
+            db_pk = next(db_pks, None)
+
+        if last is not None and pk <= last:
+            raise ValueError("The pks from ES and the database are not sorted the same way (%r came after %r)" % (pk, last))
+        last = pk
+        yield pk, in_es, in_db
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--using', action="append", dest='using',
+                    help="Only touch indexes in this connection from settings.ELASTICSEARCH_CONNECTIONS"),
+        make_option('--chunk-size', action="store", type="int", default=1000, dest='chunk_size',
+                    help="The number of pks to fetch, delete or reindex at a time"),
+        make_option('--dry-run', action="store_true", default='', dest='dry_run',
+                    help="Only report the differences"),
+    )
+    args = '<app[.model] app[.model] ...>'
+    help = "Deletes documents that aren't in Index.get_queryset() and indexes objects that are missing from ES"
+
+    def get_pk_field(self, index):
+        """
+        Returns the name of the field on the Index that holds the model's pk,
+        which is what the documents are sorted by
+        """
+        pk_name = index._doc_type.model._meta.pk.name
+        for name, field in index._doc_type._fields().items():
+            if name in (pk_name, "pk") or getattr(field, "_path", None) in ([pk_name], ["pk"]):
+                return name
+        raise CommandError(
+            "%s needs a field for the model's pk (add '%s' to Meta.fields) so the documents can be sorted by it" % (index, pk_name)
+        )
+
+    def es_pks(self, index, chunk_size):
+        """
+        Generate the pk of every document for the Index in ES, in order
+        """
+        to_python = index._doc_type.model._meta.pk.to_python
+        hits = scan(
+            index.es,
+            query={"query": {"match_all": {}}, "sort": [{self.get_pk_field(index): "asc"}], "_source": False},
+            index=index._doc_type.index,
+            doc_type=index._doc_type.mapping.doc_type,
+            size=chunk_size,
+            preserve_order=True,
+        )
+        for hit in hits:
+            yield to_python(hit['_id'])
+
+    def handle(self, *args, **options):
+        models = get_models(args)
+        usings = options.get("using") or settings.ELASTICSEARCH_CONNECTIONS.keys()
+        chunk_size = options.get("chunk_size") or 1000
+
+        for using in usings:
+            for model in models:
+                for index in registry.indexes_for_model(model):
+                    if index._doc_type.using == using:
+                        self.reconcile(index, chunk_size, dry_run=options.get("dry_run"))
+
+    def reconcile(self, index, chunk_size, dry_run=False):
+        """
+        Merge join the sorted pks in ES and the database, and fix the
+        differences chunk_size at a time, so memory use stays constant
+        """
+        qs = index.get_queryset()
+        orphans = []
+        missing = []
+        deleted = indexed = 0
+
+        try:
+            for pk, in_es, in_db in merge_join(self.es_pks(index, chunk_size), keyset_pks(qs, chunk_size)):
+                if in_es and not in_db:
+                    orphans.append(pk)
+                elif in_db and not in_es:
+                    missing.append(pk)
+
+                if len(orphans) >= chunk_size:
+                    deleted += self.delete(index, orphans, dry_run)
+                    orphans = []
+                if len(missing) >= chunk_size:
+                    indexed += self.reindex(index, qs, missing, dry_run)
+                    missing = []
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        deleted += self.delete(index, orphans, dry_run)
+        indexed += self.reindex(index, qs, missing, dry_run)
+
+        self.stdout.write("%s: %s %d orphaned documents, %s %d missing objects" % (
+            index,
+            "found" if dry_run else "deleted",
+            deleted,
+            "found" if dry_run else "indexed",
+            indexed,
+        ))
+
+    def delete(self, index, pks, dry_run):
+        if pks and not dry_run:
+            index.delete_pks(pks)
+        return len(pks)
+
+    def reindex(self, index, qs, pks, dry_run):
+        if pks and not dry_run:
+            index.update(qs.filter(pk__in=pks))
+        return len(pks)
@@ -1,15 +1,19 @@
 import re
+from contextlib import ExitStack
 from datetime import timedelta
 from optparse import make_option
 
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.db.models import Max
 from django.forms import DateTimeField
 from django.core.exceptions import ValidationError
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
 from ...indexes import registry
-from . import get_models
+from ...indices import bulk_mode
+from . import get_models, keyset_chunks, load_state, save_state, state_key
 
 
 class Command(BaseCommand):
@@ -20,6 +24,22 @@ class Command(BaseCommand):
                     help='Index data updated on before this time.  yyyy-mm-dd[-hh:mm] or [#d][#h][#m][#s]'),
         make_option('--using', action="append", dest='using',
                     help="Only touch indexes in this connection from settings.ELASTICSEARCH_CONNECTIONS"),
+        make_option('--bulk-mode', action="store_true", default='', dest='bulk_mode',
+                    help="Disable refreshes and replicas while indexing"),
+        make_option('--chunk-size', action="store", type="int", default=1000, dest='chunk_size',
+                    help="The number of objects to fetch from the database (in pk order) and index at a time"),
+        make_option('--checkpoint', action="store", default='.update_index_checkpoint.json', dest='checkpoint',
+                    help="The file where the last pk indexed for each index is recorded"),
+        make_option('--resume', action="store_true", default='', dest='resume',
+                    help="Continue from the pks recorded in the checkpoint file by a run that didn't finish"),
+        make_option('--since-last', action="store_true", default='', dest='since_last',
+                    help="Only index data updated since the latest Meta.date_field value indexed by the last run (minus --margin)"),
+        make_option('--margin', action="store", default='5m', dest='margin',
+                    help="How far before the last run's latest date_field value --since-last starts.  [#d][#h][#m][#s]"),
+        make_option('--watermarks', action="store", default='.update_index_watermarks.json', dest='watermarks',
+                    help="The file where --since-last records the latest date_field value indexed for each index"),
+        make_option('--dead-letter', action="store", default='', dest='dead_letter',
+                    help="Append the bulk actions that fail to this NDJSON file, instead of stopping"),
     )
     args = '<app[.model] app[.model] ...>'
     help = 'Creates and populates the search index.'
@@ -31,6 +51,13 @@ class Command(BaseCommand):
         r"(?:(?P<seconds>\d+)S)?$",
         flags=re.IGNORECASE)
 
+    def parse_duration(self, input):
+        match = self.duration_re.match(input)
+        if match:
+            kwargs = dict((k, int(v)) for (k, v) in match.groupdict().items() if v is not None)
+            return timedelta(**kwargs)
+        return None
+
     def parse_date_time(self, input):
         field = DateTimeField()
         try:
@@ -38,13 +65,21 @@ class Command(BaseCommand):
         except ValidationError:
             pass
 
-        match = self.duration_re.match(input)
-        if match:
-            kwargs = dict((k, int(v)) for (k, v) in match.groupdict().items() if v is not None)
-            return timezone.now() - timedelta(**kwargs)
+        duration = self.parse_duration(input)
+        if duration is not None:
+            return timezone.now() - duration
 
         raise ValueError("%s could not be interpereted as a datetime" % input)
 
+    def get_high_watermark(self, qs, date_field):
+        """
+        Returns the latest value of the date_field in the queryset
+        """
+        return qs.aggregate(high_watermark=Max(date_field))['high_watermark']
+
+    def parse_watermark(self, value):
+        return parse_datetime(value) or parse_date(value)
+
     def handle(self, *args, **options):
         start = None
         if options.get('start'):
@@ -58,13 +93,96 @@ class Command(BaseCommand):
 
         usings = options.get("using") or settings.ELASTICSEARCH_CONNECTIONS.keys()
 
+        bulk = options.get("bulk_mode")
+        chunk_size = options.get("chunk_size") or 1000
+        checkpoint = options.get("checkpoint") or ".update_index_checkpoint.json"
+        # the checkpoints of the other indexes are kept, even if we're not resuming
+        checkpoints = load_state(checkpoint)
+        resume = options.get("resume")
+
+        dead_letter = options.get("dead_letter") or None
+        since_last = options.get("since_last")
+        watermarks_path = options.get("watermarks") or ".update_index_watermarks.json"
+        watermarks = load_state(watermarks_path)
+        margin = self.parse_duration(options.get("margin") or "5m")
+        if margin is None:
+            raise CommandError("%s could not be interpreted as a duration" % options.get("margin"))
+
         for using in usings:
-            for model in models:
-                for index in registry.indexes_for_model(model):
-                    if index._doc_type.using == using:
-                        self.stdout.write("Putting mapping for %s" % str(index))
-                        index.put_mapping()
-
-                        qs = index.get_queryset(start=start, end=end)
-                        self.stdout.write("Indexing %d %s objects" % (qs.count(), model.__name__))
-                        index.update(qs.iterator())
+            with ExitStack() as stack:
+                if bulk:
+                    # the settings are restored (and the index refreshed) when
+                    # the with block exits, even on Ctrl-C
+                    stack.enter_context(bulk_mode(using))
+
+                for model in models:
+                    for index in registry.indexes_for_model(model):
+                        if index._doc_type.using == using:
+                            self.stdout.write("Putting mapping for %s" % str(index))
+                            index.put_mapping()
+
+                            index_start = start
+                            if since_last:
+                                date_field = index._doc_type.date_field
+                                if not date_field:
+                                    self.stderr.write("Skipping %s since it has no Meta.date_field" % index)
+                                    continue
+
+                                watermark = watermarks.get(state_key(index))
+                                if watermark is not None:
+                                    # the margin covers rows that were saved with a
+                                    # date_field value before the last run, but
+                                    # committed after it
+                                    index_start = self.parse_watermark(watermark) - margin
+
+                            qs = index.get_queryset(start=index_start, end=end)
+                            # find the watermark before indexing, so rows saved while
+                            # we're running are picked up by the next run
+                            high_watermark = self.get_high_watermark(qs, date_field) if since_last else None
+
+                            after = checkpoints.get(state_key(index)) if resume else None
+                            errors = self.index(index, qs, after, checkpoints, checkpoint, chunk_size, refresh=not bulk, dead_letter=dead_letter)
+                            if errors:
+                                # the failed objects have to be picked up by
+                                # the next run, so the watermark stays put
+                                self.stderr.write("%d %s objects could not be indexed (see %s)" % (errors, index._doc_type.model.__name__, dead_letter))
+                                continue
+
+                            if high_watermark is not None:
+                                watermarks[state_key(index)] = high_watermark.isoformat()
+                                save_state(watermarks_path, watermarks)
+
+    def index(self, index, qs, after, checkpoints, checkpoint, chunk_size, refresh=True, dead_letter=None):
+        """
+        Index the objects in the queryset with a pk greater than `after` (if
+        it isn't None) in pk order, chunk_size objects at a time, recording the
+        last pk indexed in the checkpoint file after each chunk. If
+        dead_letter is a path, the actions that fail are written to it, and
+        the indexing carries on.
+
+        Returns the number of actions that failed
+        """
+        bulk_kwargs = {}
+        if dead_letter:
+            bulk_kwargs = {"dead_letter": dead_letter, "raise_on_error": False}
+
+        key = state_key(index)
+        model = index._doc_type.model
+        if after is not None:
+            after = model._meta.pk.to_python(after)
+            qs = qs.filter(pk__gt=after)
+            self.stdout.write("Resuming %s after pk %s" % (index, after))
+
+        self.stdout.write("Indexing %d %s objects" % (qs.count(), model.__name__))
+        errors = 0
+        for chunk in keyset_chunks(qs, chunk_size):
+            success, failed = index.update(chunk, refresh=refresh, **bulk_kwargs)
+            errors += len(failed)
+            last_pk = chunk[-1].pk
+            checkpoints[key] = last_pk if isinstance(last_pk, int) else str(last_pk)
+            save_state(checkpoint, checkpoints)
+
+        # we finished, so there is nothing to resume
+        checkpoints.pop(key, None)
+        save_state(checkpoint, checkpoints)
+        return errors
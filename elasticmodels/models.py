@@ -0,0 +1,2 @@
+# the system checks are registered when the models are loaded
+from . import checks  # noqa
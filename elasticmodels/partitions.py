@@ -0,0 +1,70 @@
+import datetime
+
+from django.utils import timezone
+
+# the strftime format of the part of a partition's index name that identifies
+# its period. They all sort in chronological order
+PARTITION_FORMATS = {
+    "year": "%Y",
+    "month": "%Y.%m",
+    "day": "%Y.%m.%d",
+}
+
+
+def to_date(value):
+    """
+    Returns the date of a date or datetime. Aware datetimes are converted to
+    UTC first, so a document always lands in the same partition no matter what
+    the current timezone is
+    """
+    if isinstance(value, datetime.datetime):
+        if timezone.is_aware(value):
+            value = value.astimezone(timezone.utc)
+        return value.date()
+    return value
+
+
+def truncate(value, partition):
+    """
+    Returns the first date of the period the date or datetime is in
+    """
+    value = to_date(value)
+    if partition == "year":
+        return value.replace(month=1, day=1)
+    if partition == "month":
+        return value.replace(day=1)
+    return value
+
+
+def next_period(value, partition):
+    """
+    Returns the first date of the period after the one the date is in
+    """
+    value = truncate(value, partition)
+    if partition == "year":
+        return value.replace(year=value.year + 1)
+    if partition == "month":
+        if value.month == 12:
+            return value.replace(year=value.year + 1, month=1)
+        return value.replace(month=value.month + 1)
+    return value + datetime.timedelta(days=1)
+
+
+def partition_suffix(value, partition):
+    """
+    Returns the part of the partition's index name for the date or datetime
+    """
+    return to_date(value).strftime(PARTITION_FORMATS[partition])
+
+
+def partition_suffixes(start, end, partition):
+    """
+    Returns the suffixes for every partition between start and end (inclusive)
+    """
+    suffixes = []
+    value = truncate(start, partition)
+    end = to_date(end)
+    while value <= end:
+        suffixes.append(partition_suffix(value, partition))
+        value = next_period(value, partition)
+    return suffixes
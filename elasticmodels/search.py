@@ -0,0 +1,513 @@
+import json
+import time
+import asyncio
+import hashlib
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from elasticsearch.exceptions import HTTP_EXCEPTIONS, TransportError
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.result import Response
+
+try:
+    from elasticsearch_async import AsyncElasticsearch
+except ImportError:
+    AsyncElasticsearch = None
+
+# the attribute of an event loop where its AsyncElasticsearch clients are
+# kept. The clients reference their loop, so keeping them anywhere else would
+# keep every loop (and its clients) alive forever
+ASYNC_CONNECTIONS_ATTR = "_elasticmodels_connections"
+
+
+def get_connection(using):
+    """
+    Returns the Elasticsearch client for the `using` connection (see
+    IndexRegistry.get_connection)
+    """
+    from .indexes import registry
+    return registry.get_connection(using)
+
+
+def get_async_connection(using):
+    """
+    Returns the AsyncElasticsearch client for the `using` connection on the
+    current event loop
+    """
+    if AsyncElasticsearch is None:
+        raise ImproperlyConfigured("The elasticsearch-async package is required to use the asyncio API")
+
+    loop = asyncio.get_event_loop()
+    clients = getattr(loop, ASYNC_CONNECTIONS_ATTR, None)
+    if clients is None:
+        clients = {}
+        setattr(loop, ASYNC_CONNECTIONS_ATTR, clients)
+    if using not in clients:
+        from .indexes import registry
+        from .connection import CompressedHttpConnection
+        registry.configure()
+        kwargs = dict(registry.connection_kwargs[using])
+        # compression is only supported by the synchronous client
+        if kwargs.get("connection_class") is CompressedHttpConnection:
+            del kwargs["connection_class"]
+        clients[using] = AsyncElasticsearch(loop=loop, **kwargs)
+    return clients[using]
+
+
+def run_sync(func, *args, **kwargs):
+    """
+    Run the blocking function in the event loop's default executor. This is
+    how coroutines use the ORM and the Django cache, which have no asyncio API
+    """
+    return asyncio.get_event_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+def get_cache():
+    """
+    Returns the Django cache used to store search results
+    """
+    return caches[getattr(settings, "ELASTICMODELS_CACHE", "default")]
+
+
+def generation_key(index, doc_type):
+    return "elasticmodels:generation:%s:%s" % (index, doc_type)
+
+
+def get_generation(index, doc_type):
+    """
+    Returns the current generation of the doc_type in the index. Every write
+    to the doc_type bumps the generation, which orphans all the cached search
+    results for it
+    """
+    cache = get_cache()
+    key = generation_key(index, doc_type)
+    generation = cache.get(key)
+    if generation is None:
+        # if the key was evicted, we can't start counting at 0 again, or we
+        # could pick up stale results that were cached under an old generation
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(index, doc_type):
+    cache = get_cache()
+    key = generation_key(index, doc_type)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # the key doesn't exist (yet, or anymore)
+        cache.add(key, int(time.time() * 1000), timeout=None)
+
+
+class IndexSearch(Search):
+    """
+    The elasticsearch-dsl Search class returned by Index.search() (and hence
+    Index.objects.filter(), query() and all()).
+
+    If cache_timeout is not None, the raw responses of execute() and count()
+    are stored in the Django cache for that many seconds, or until the
+    Index is written to
+    """
+    # the search parameters that the count API also accepts
+    count_params = ("routing", "preference", "ignore_unavailable", "allow_no_indices", "expand_wildcards")
+
+    def __init__(self, *args, cache_timeout=None, generations=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cache_timeout = cache_timeout
+        # the (index, doc_type) pairs whose generations the cached results
+        # depend on. By default, every index and doc_type searched
+        self._generations = generations
+
+    def _clone(self):
+        s = super()._clone()
+        s._cache_timeout = self._cache_timeout
+        s._generations = self._generations
+        return s
+
+    def cache(self, timeout):
+        """
+        Return a copy of this search that caches its results for `timeout`
+        seconds. None disables the cache
+        """
+        s = self._clone()
+        s._cache_timeout = timeout
+        return s
+
+    def cache_key(self, action, body):
+        pairs = self._generations
+        if pairs is None:
+            pairs = [(index, doc_type) for index in self._index or [] for doc_type in self._doc_type]
+        key = json.dumps({
+            "action": action,
+            "index": self._index,
+            "doc_type": self._doc_type,
+            "body": body,
+            "params": self._params,
+            "generations": [get_generation(index, doc_type) for index, doc_type in pairs],
+        }, sort_keys=True, default=str)
+        return "elasticmodels:search:%s" % hashlib.md5(key.encode("utf8")).hexdigest()
+
+    def _cached(self, action, body, func):
+        """
+        Return the cached result for the request, or call func() and cache the
+        result. The key is computed once, before the request is made, so a
+        write during the request orphans the result instead of it being
+        stored under the new generation
+        """
+        if self._cache_timeout is None:
+            return func()
+
+        cache = get_cache()
+        key = self.cache_key(action, body)
+        result = cache.get(key)
+        if result is None:
+            result = func()
+            cache.set(key, result, self._cache_timeout)
+        return result
+
+    async def _acached(self, action, body, func):
+        """
+        The asyncio version of _cached(). func() should return an awaitable
+        """
+        if self._cache_timeout is None:
+            return await func()
+
+        cache = get_cache()
+        key = await run_sync(self.cache_key, action, body)
+        result = await run_sync(cache.get, key)
+        if result is None:
+            result = await func()
+            await run_sync(cache.set, key, result, self._cache_timeout)
+        return result
+
+    def get_count_params(self):
+        return dict((key, value) for key, value in self._params.items() if key in self.count_params)
+
+    def count(self):
+        body = self.to_dict(count=True)
+
+        def count():
+            es = get_connection(self._using)
+            return es.count(index=self._index, doc_type=self._doc_type, body=body, **self.get_count_params())['count']
+
+        return self._cached("count", body, count)
+
+    def execute(self, response_class=Response):
+        body = self.to_dict()
+
+        def search():
+            es = get_connection(self._using)
+            return es.search(index=self._index, doc_type=self._doc_type, body=body, **self._params)
+
+        return response_class(self._cached("search", body, search), callbacks=self._doc_type_map)
+
+    async def acount(self):
+        body = self.to_dict(count=True)
+
+        async def count():
+            es = get_async_connection(self._using)
+            return (await es.count(index=self._index, doc_type=self._doc_type, body=body, **self.get_count_params()))['count']
+
+        return await self._acached("count", body, count)
+
+    async def aexecute(self, response_class=Response):
+        body = self.to_dict()
+
+        async def search():
+            es = get_async_connection(self._using)
+            return await es.search(index=self._index, doc_type=self._doc_type, body=body, **self._params)
+
+        return response_class(await self._acached("search", body, search), callbacks=self._doc_type_map)
+
+
+class SearchBatch:
+    """
+    Collects searches and counts, and sends all the pending ones in a single
+    _msearch request the first time one of their results is needed:
+
+        with CarIndex.objects.batch() as batch:
+            results = batch.execute(CarIndex.objects.query(...)[0:10])
+            red = batch.count(CarIndex.objects.filter("term", color="red"))
+            blue = batch.count(CarIndex.objects.filter("term", color="blue"))
+
+        # this sends the three searches in one request
+        len(results), red.value, blue.value
+    """
+    # the search parameters that can be put in an _msearch header
+    header_params = ("search_type", "preference", "routing", "ignore_unavailable")
+
+    def __init__(self, using):
+        self.using = using
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def _add(self, handle):
+        if handle.search._using != self.using:
+            raise ValueError("Only searches on the '%s' connection can be batched together" % self.using)
+
+        result = None
+        if isinstance(handle.search, IndexSearch) and handle.search._cache_timeout is not None:
+            # the key is kept until the response is stored (see
+            # IndexSearch._cached())
+            handle.cache_key = handle.search.cache_key(handle.action, handle.body)
+            result = get_cache().get(handle.cache_key)
+        if result is not None:
+            handle.resolve(result)
+        else:
+            self.pending.append(handle)
+        return handle
+
+    def execute(self, search, response_class=Response):
+        """
+        Returns a LazyResponse for the search
+        """
+        return self._add(LazyResponse(self, search, search.to_dict(), response_class))
+
+    def count(self, search):
+        """
+        Returns a LazyCount for the search
+        """
+        return self._add(LazyCount(self, search, search.to_dict(count=True, size=0)))
+
+    def flush(self):
+        """
+        Send all the pending searches to ES
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        body = []
+        for handle in pending:
+            header = dict((k, v) for k, v in handle.search._params.items() if k in self.header_params)
+            if handle.search._index:
+                header['index'] = handle.search._index
+            if handle.search._doc_type:
+                header['type'] = handle.search._doc_type
+            body.append(header)
+            body.append(handle.body)
+
+        try:
+            responses = get_connection(self.using).msearch(body=body)['responses']
+        except Exception as e:
+            # the handles aren't pending anymore, so they have to fail too,
+            # or they would resolve to nothing
+            for handle in pending:
+                handle.error = e
+            raise
+
+        for handle, raw in zip(pending, responses):
+            if "error" in raw:
+                status = raw.get("status", 400)
+                handle.error = HTTP_EXCEPTIONS.get(status, TransportError)(status, raw["error"], raw)
+                continue
+
+            if handle.action == "count":
+                raw = raw['hits']['total']
+            if handle.cache_key is not None:
+                get_cache().set(handle.cache_key, raw, handle.search._cache_timeout)
+            handle.resolve(raw)
+
+
+class LazyResult:
+    """
+    The base class for the handles returned by SearchBatch
+    """
+    action = None
+
+    def __init__(self, batch, search, body):
+        self.batch = batch
+        self.search = search
+        self.body = body
+        self.resolved = False
+        self.error = None
+        self.cache_key = None
+        self._raw = None
+
+    def resolve(self, raw):
+        self._raw = raw
+        self.resolved = True
+
+    def get_raw(self):
+        if not self.resolved and self.error is None:
+            self.batch.flush()
+        if self.error is not None:
+            raise self.error
+        return self._raw
+
+
+class LazyResponse(LazyResult):
+    """
+    Stands in for the Response of Search.execute()
+    """
+    action = "search"
+
+    def __init__(self, batch, search, body, response_class=Response):
+        super().__init__(batch, search, body)
+        self.response_class = response_class
+        self._response = None
+
+    @property
+    def response(self):
+        if self._response is None:
+            self._response = self.response_class(self.get_raw(), callbacks=self.search._doc_type_map)
+        return self._response
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def __len__(self):
+        return len(self.response)
+
+    def __getitem__(self, key):
+        return self.response[key]
+
+    def __bool__(self):
+        return bool(self.response)
+
+
+class LazyCount(LazyResult):
+    """
+    Stands in for the result of Search.count(). Use the value attribute, or
+    int()
+    """
+    action = "count"
+
+    @property
+    def value(self):
+        return self.get_raw()
+
+    def __int__(self):
+        return self.value
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __repr__(self):
+        return "<LazyCount: %s>" % (self.value if self.resolved else "pending")
+
+
+def hydrate(hits, queryset=None):
+    """
+    Convert the search hits to model objects, in the same order. Hits that
+    aren't in the queryset are dropped. If queryset is None (like for a search
+    across several indexes), the hits are grouped by model, and each group is
+    loaded with one query on the get_queryset() of the hit's Index
+    """
+    querysets = {}
+    ids = {}
+    for hit in hits:
+        model = None if queryset is not None else type(hit)._doc_type.model
+        if model not in querysets:
+            querysets[model] = queryset if queryset is not None else type(hit).objects.get_queryset()
+            ids[model] = []
+        ids[model].append(hit.meta.id)
+
+    pk_to_model = {}
+    for model, qs in querysets.items():
+        for row in qs.filter(pk__in=ids[model]):
+            pk_to_model[(model, str(row.pk))] = row
+
+    # we need to return the model objects in the order they were retrieved
+    # from ES
+    to_return = []
+    for hit in hits:
+        key = (None if queryset is not None else type(hit)._doc_type.model, hit.meta.id)
+        if key in pk_to_model:
+            to_return.append(pk_to_model[key])
+    return to_return
+
+
+class InstanceLoader:
+    """
+    Loads the model instances for a page of SourceResults with a single query,
+    the first time any of them needs one
+    """
+    def __init__(self, queryset, pks):
+        self.queryset = queryset
+        self.pks = pks
+        self.instances = None
+
+    def get(self, pk):
+        if self.instances is None:
+            self.instances = self.queryset.in_bulk(self.pks)
+        try:
+            return self.instances[pk]
+        except KeyError:
+            raise self.queryset.model.DoesNotExist("%s with pk %r is not in the queryset" % (self.queryset.model.__name__, pk))
+
+
+class SourceResult:
+    """
+    A read-only stand in for a model instance, built from the _source of a
+    search hit. Index.result_class() generates a subclass with a slot for each
+    field on the Index, so the attribute names match the model's. The
+    attributes listed in the Index's Meta.lazy_fields are loaded from the
+    database when they are accessed.
+    """
+    __slots__ = ("pk", "meta", "_loader")
+    field_names = ()
+    lazy_fields = frozenset()
+
+    def __init__(self, pk, source, meta=None, loader=None):
+        object.__setattr__(self, "pk", pk)
+        object.__setattr__(self, "meta", meta)
+        object.__setattr__(self, "_loader", loader)
+        for name in self.field_names:
+            object.__setattr__(self, name, source.get(name))
+
+    def __getattr__(self, name):
+        # this is only called when the attribute isn't in a slot
+        if name in self.lazy_fields and self._loader is not None:
+            return getattr(self._loader.get(self.pk), name)
+        raise AttributeError("%r object has no attribute %r" % (self.__class__.__name__, name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s objects are read-only" % self.__class__.__name__)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.pk == other.pk
+
+    def __hash__(self):
+        return hash((type(self), self.pk))
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self.pk)
+
+
+def source_results(hits, queryset=None):
+    """
+    Convert the search hits (which are Index instances) into SourceResults.
+    Lazy fields are loaded from `queryset`, or the Index's get_queryset()
+    """
+    pks_by_index = {}
+    for hit in hits:
+        index = type(hit)
+        pks_by_index.setdefault(index, []).append(index._doc_type.model._meta.pk.to_python(hit.meta.id))
+
+    loaders = {}
+    for index, pks in pks_by_index.items():
+        if index._doc_type.lazy_fields:
+            loaders[index] = InstanceLoader(queryset if queryset is not None else index.objects.get_queryset(), pks)
+
+    results = []
+    for hit in hits:
+        index = type(hit)
+        results.append(index.result_class()(
+            pk=index._doc_type.model._meta.pk.to_python(hit.meta.id),
+            source=hit.to_dict(),
+            meta=hit.meta,
+            loader=loaders.get(index),
+        ))
+    return results
@@ -0,0 +1,57 @@
+import json
+import uuid
+import datetime
+from decimal import Decimal
+
+from django.utils.encoding import force_text
+from django.utils.functional import Promise
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class DjangoJSONSerializer(JSONSerializer):
+    """
+    A serializer for the elasticsearch client that understands the types
+    Django models are made of (lazy translation strings, Decimals, UUIDs and
+    timezone aware datetimes). If the orjson package is installed, it is used
+    to do the encoding and decoding, which is much faster than the json module
+    on big bulk requests
+    """
+    def default(self, data):
+        if isinstance(data, Promise):
+            return force_text(data)
+        if isinstance(data, uuid.UUID):
+            return str(data)
+        if isinstance(data, Decimal):
+            return float(data)
+        if isinstance(data, (datetime.datetime, datetime.date, datetime.time)):
+            return data.isoformat()
+        if isinstance(data, (set, frozenset)):
+            return list(data)
+        return super().default(data)
+
+    def loads(self, s):
+        if orjson is None:
+            return super().loads(s)
+
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+
+        try:
+            if orjson is None:
+                return json.dumps(data, default=self.default, ensure_ascii=False, separators=(",", ":"))
+            return orjson.dumps(data, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
@@ -1,26 +1,47 @@
+import gc
 import os
+import gzip
+import json
+import uuid
+from decimal import Decimal
+import asyncio
 import tempfile
+import weakref
 import datetime
 from unittest.mock import Mock, patch
-from elasticsearch import Elasticsearch, NotFoundError
-from collections import defaultdict
+from elasticsearch import Elasticsearch, NotFoundError, RequestError, ConnectionError
+from elasticsearch.helpers import BulkIndexError
+from elasticsearch.exceptions import SerializationError
+from collections import defaultdict, OrderedDict
 import time
 
 from elasticsearch_dsl import Search
 from django.db import models, connection
 from django.test import TestCase
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.checks.registry import registry as check_registry
+from django.core.management.base import CommandError
 from django.utils.timezone import utc, now
 from django.utils import timezone
+from django.utils.translation import ugettext_lazy
 from model_mommy.mommy import prepare, make
 
 from .fields import EMField, TemplateField, StringField, ObjectField, ListField
 from .indexes import Index, suspended_updates, IndexRegistry
-from .exceptions import VariableLookupError, RedeclaredFieldError
+from .bulk import AdaptiveBulkSender, bulk as adaptive_bulk
+from .serializers import DjangoJSONSerializer
+from .connection import CompressedHttpConnection
+from .search import IndexSearch, SearchBatch, bump_generation, source_results, hydrate, get_async_connection
+from .exceptions import VariableLookupError, RedeclaredFieldError, InvalidPartitionError, ModelFieldNotMappedError
+from .checks import check_indexes
 from .management.commands.clear_index import Command as ClearCommand
 from .management.commands.update_index import Command as UpdateCommand
-from .management.commands import get_models
-from .forms import SearchForm, BaseSearchForm, Pageable
+from .management.commands.rebuild_index import Command as RebuildCommand
+from .management.commands.reconcile_index import Command as ReconcileCommand, merge_join
+from .indices import swap_alias, bulk_mode, changed_settings, create_index, copy_from_source
+from .management.commands import get_models, keyset_chunks, load_state
+from .forms import SearchForm, BaseSearchForm, Pageable, AsyncPageable
 
 
 class ESTest(TestCase):
@@ -44,6 +65,24 @@ class Dummy:
         return getattr(self, name)
 
 
+class FakeQuerySet(list):
+    """
+    A list of objects that supports the parts of the QuerySet API the
+    management commands use
+    """
+    def count(self):
+        return len(self)
+
+    def order_by(self, *fields):
+        return FakeQuerySet(sorted(self, key=lambda obj: obj.pk))
+
+    def filter(self, pk__gt):
+        return FakeQuerySet(obj for obj in self if obj.pk > pk__gt)
+
+    def iterator(self):
+        return iter(self)
+
+
 class EMFieldTest(TestCase):
     def test_get_from_instance(self):
         field = EMField(attr="alpha.beta.gamma")
@@ -192,6 +231,31 @@ class IndexTest(ESTest):
     def test_fields_populated(self):
         self.assertEqual(set(self.CarIndex.objects._doc_type.mapping.properties.properties.to_dict().keys()), set(["color", "name"]))
 
+    def test_mapping_is_built_lazily(self):
+        class Car(models.Model):
+            name = models.CharField(max_length=255)
+
+        class CarIndex(Index):
+            class Meta:
+                fields = ['name', 'wheels']
+                model = Car
+
+        # the bad field name isn't noticed until the mapping is used
+        self.assertIsNotNone(CarIndex._doc_type.__dict__['_builder'])
+        with self.assertRaises(ModelFieldNotMappedError):
+            CarIndex._doc_type.mapping
+
+        # and the system check reports it
+        with patch("elasticmodels.checks.registry.get_indexes", Mock(return_value=[CarIndex.objects])):
+            errors = check_indexes()
+        self.assertEqual([error.id for error in errors], ["elasticmodels.E001"])
+        self.assertEqual(errors[0].obj, CarIndex)
+
+        # the fields are added to the mapping the first time it's used
+        self.assertIsNotNone(self.CarIndex._doc_type.__dict__['_builder'])
+        self.assertIn("name", self.CarIndex._doc_type._fields())
+        self.assertIsNone(self.CarIndex._doc_type.__dict__['_builder'])
+
     def test_doc_type(self):
         self.assertEqual(self.CarIndex._doc_type.mapping.doc_type, "elasticmodels_car")
 
@@ -239,6 +303,11 @@ class IndexTest(ESTest):
                                 'type': 'string'
                             }
                         },
+                        '_meta': {
+                            'elasticmodels_fingerprint': self.CarIndex.objects.mapping_fingerprint(),
+                            # the index was created with the analysis
+                            'elasticmodels_analysis_fingerprint': self.CarIndex.objects.analysis_fingerprint(),
+                        },
                         #'dynamic': 'strict'
                     }
                 }
@@ -247,6 +316,37 @@ class IndexTest(ESTest):
         # putting the mapping twice shouldn't be a problem
         self.CarIndex.objects.put_mapping()
 
+    def test_put_mapping_skipped_when_current(self):
+        es = Mock()
+        es.indices.get_mapping = Mock(return_value={"elasticmodels-unit-test-db": {"mappings": {"elasticmodels_car": {
+            "_meta": {"elasticmodels_fingerprint": self.CarIndex.objects.mapping_fingerprint()},
+        }}}})
+        with patch("elasticmodels.indexes.Index.es", es):
+            self.assertTrue(self.CarIndex.objects.mapping_is_current())
+            self.CarIndex.objects.put_mapping()
+            self.assertFalse(es.indices.exists.called)
+            self.assertFalse(es.indices.put_mapping.called)
+
+            # a changed mapping is put
+            es.indices.get_mapping.return_value = {"elasticmodels-unit-test-db": {"mappings": {"elasticmodels_car": {
+                "_meta": {"elasticmodels_fingerprint": "something else"},
+            }}}}
+            self.assertFalse(self.CarIndex.objects.mapping_is_current())
+            es.indices.exists = Mock(return_value=True)
+            self.CarIndex.objects.put_mapping()
+            self.assertTrue(es.indices.put_mapping.called)
+            # put_mapping() can't change the analysis of an existing index, so
+            # the analysis isn't claimed to be current
+            meta = es.indices.put_mapping.call_args[1]['body']['elasticmodels_car']['_meta']
+            self.assertNotIn("elasticmodels_analysis_fingerprint", meta)
+            self.assertFalse(self.CarIndex.objects.analysis_is_current())
+
+            # unless the caller knows it was applied
+            es.indices.put_mapping.reset_mock()
+            self.CarIndex.objects.put_mapping(analysis_applied=True)
+            meta = es.indices.put_mapping.call_args[1]['body']['elasticmodels_car']['_meta']
+            self.assertEqual(meta["elasticmodels_analysis_fingerprint"], self.CarIndex.objects.analysis_fingerprint())
+
     def test_delete_mapping(self):
         self.CarIndex.objects.put_mapping()
         self.assertEqual(1, len(self.CarIndex.objects.es.indices.get_mapping(index=self.CarIndex.objects._doc_type.index, doc_type=self.CarIndex.objects._doc_type.mapping.doc_type)))
@@ -333,6 +433,613 @@ class IndexTest(ESTest):
         }, prepared)
 
 
+class ChecksTest(TestCase):
+    def test_check_is_opt_in(self):
+        # building every mapping would slow down every management command, so
+        # the check only runs with check --deploy
+        self.assertNotIn(check_indexes, check_registry.get_checks(include_deployment_checks=False))
+        self.assertIn(check_indexes, check_registry.get_checks(include_deployment_checks=True))
+
+
+class IndexSearchTest(TestCase):
+    def test_cache(self):
+        es = Mock()
+        es.search = Mock(return_value={"hits": {"hits": [], "total": 0}})
+        es.count = Mock(return_value={"count": 0})
+        search = IndexSearch(index="foo", doc_type="bar", cache_timeout=60).query("match", name="baz")
+        with patch("elasticmodels.search.get_connection", Mock(return_value=es)):
+            search.execute()
+            search.execute()
+            search.count()
+            search.count()
+            self.assertEqual(es.search.call_count, 1)
+            self.assertEqual(es.count.call_count, 1)
+
+            # a different query isn't cached
+            search.query("match", name="qux").execute()
+            self.assertEqual(es.search.call_count, 2)
+
+            # a write to the index invalidates the cache
+            bump_generation("foo", "bar")
+            search.execute()
+            self.assertEqual(es.search.call_count, 3)
+
+            # searches without a timeout are never cached
+            search.cache(None).execute()
+            search.cache(None).execute()
+            self.assertEqual(es.search.call_count, 5)
+
+    def test_write_during_search(self):
+        es = Mock()
+
+        def search_and_write(**kwargs):
+            # the index is written to while the search is running
+            bump_generation("foo", "bar")
+            return {"hits": {"hits": [], "total": 0}}
+
+        es.search = Mock(side_effect=search_and_write)
+        search = IndexSearch(index="foo", doc_type="bar", cache_timeout=60)
+        with patch("elasticmodels.search.get_connection", Mock(return_value=es)):
+            search.execute()
+            # the stale response wasn't stored under the new generation
+            search.execute()
+            self.assertEqual(es.search.call_count, 2)
+
+
+class SearchBatchTest(TestCase):
+    def test_batch(self):
+        es = Mock()
+        es.msearch = Mock(return_value={"responses": [
+            {"hits": {"hits": [{"_id": "1", "_type": "bar", "_source": {}}], "total": 1}},
+            {"hits": {"hits": [], "total": 5}},
+            {"error": "SearchParseException[...]"},
+        ]})
+        search = IndexSearch(index="foo", doc_type="bar")
+        with patch("elasticmodels.search.get_connection", Mock(return_value=es)):
+            with SearchBatch("default") as batch:
+                results = batch.execute(search.query("match", name="baz"))
+                count = batch.count(search.filter("term", color="red").params(routing="1"))
+                bad = batch.count(search.query("match", name="!"))
+                # nothing is sent until a result is needed
+                self.assertFalse(es.msearch.called)
+
+            self.assertEqual(len(results), 1)
+            self.assertEqual(count.value, 5)
+            self.assertEqual(int(count), 5)
+            with self.assertRaises(RequestError):
+                bad.value
+            # everything went out in one request
+            self.assertEqual(es.msearch.call_count, 1)
+            body = es.msearch.call_args[1]['body']
+            self.assertEqual(body[0], {"index": ["foo"], "type": ["bar"]})
+            self.assertEqual(body[2], {"index": ["foo"], "type": ["bar"], "routing": "1"})
+            self.assertEqual(body[3]['size'], 0)
+
+    def test_batch_error(self):
+        es = Mock()
+        es.msearch = Mock(side_effect=ConnectionError("N/A", "timed out", None))
+        search = IndexSearch(index="foo", doc_type="bar")
+        with patch("elasticmodels.search.get_connection", Mock(return_value=es)):
+            batch = SearchBatch("default")
+            results = batch.execute(search.query("match", name="baz"))
+            count = batch.count(search)
+            with self.assertRaises(ConnectionError):
+                count.value
+            # the other searches in the request failed too
+            with self.assertRaises(ConnectionError):
+                len(results)
+            self.assertEqual(es.msearch.call_count, 1)
+
+    def test_batch_using(self):
+        with self.assertRaises(ValueError):
+            SearchBatch("default").execute(IndexSearch(using="other"))
+
+
+class SourceResultTest(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        class Car(models.Model):
+            name = models.CharField(max_length=255)
+            description = models.TextField()
+
+        class CarIndex(Index):
+            color = StringField()
+
+            class Meta:
+                fields = ['name']
+                lazy_fields = ['description']
+                model = Car
+
+        self.Car = Car
+        self.CarIndex = CarIndex
+        self.hit = CarIndex.from_es({
+            '_id': '5',
+            '_type': CarIndex._doc_type.name,
+            '_source': {'name': 'foo', 'color': 'blue'},
+        })
+
+    def test_source_results(self):
+        queryset = Mock(in_bulk=Mock(return_value={5: Dummy(description="bar")}), model=self.Car)
+        results = source_results([self.hit], queryset)
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(result.pk, 5)
+        self.assertEqual(result.name, "foo")
+        self.assertEqual(result.color, "blue")
+        self.assertFalse(hasattr(result, "__dict__"))
+        with self.assertRaises(AttributeError):
+            result.name = "bar"
+
+        # the database isn't touched until a lazy field is accessed
+        self.assertFalse(queryset.in_bulk.called)
+        self.assertEqual(result.description, "bar")
+        queryset.in_bulk.assert_called_once_with([5])
+        self.assertEqual(result.description, "bar")
+        self.assertEqual(queryset.in_bulk.call_count, 1)
+
+        with self.assertRaises(AttributeError):
+            result.not_a_field
+
+    def test_pageable(self):
+        search = Mock()
+        search.__getitem__ = Mock(return_value=Mock(execute=Mock(return_value=[self.hit])))
+        queryset = Mock()
+        results = Pageable(search, queryset, source_only=True)[0:10]
+        self.assertEqual([result.pk for result in results], [5])
+        self.assertFalse(queryset.filter.called)
+
+
+class SourceExcludesTest(TestCase):
+    def test_excludes(self):
+        class Article(models.Model):
+            title = models.CharField(max_length=255)
+
+        class ArticleIndex(Index):
+            body = StringField(source=False)
+            author = ObjectField(properties={
+                "name": StringField(),
+                "bio": StringField(source=False),
+            })
+
+            class Meta:
+                fields = ['title']
+                model = Article
+                source_excludes = ["attachments.*"]
+
+        mapping = ArticleIndex._doc_type.mapping.to_dict()[ArticleIndex._doc_type.name]
+        self.assertEqual(mapping['_source'], {"excludes": ["attachments.*", "author.bio", "body"]})
+
+        # the excluded fields are still sent to ES, so they can be searched
+        article = Dummy(pk=1, title="foo", body="bar", author=Dummy(name="baz", bio="qux"))
+        self.assertEqual(ArticleIndex.objects.prepare(article)['body'], "bar")
+
+        # but they aren't on the results built from the _source
+        self.assertEqual(set(ArticleIndex.result_class().field_names), set(["title", "author"]))
+
+    def test_no_excludes(self):
+        class Article(models.Model):
+            title = models.CharField(max_length=255)
+
+        class ArticleIndex(Index):
+            class Meta:
+                fields = ['title']
+                model = Article
+
+        self.assertNotIn('_source', ArticleIndex._doc_type.mapping.to_dict()[ArticleIndex._doc_type.name])
+
+
+class ScanTest(TestCase):
+    def test_scan(self):
+        class Car(models.Model):
+            name = models.CharField(max_length=255)
+
+        class CarIndex(Index):
+            class Meta:
+                fields = ['name']
+                model = Car
+
+        hits = [{"_id": str(pk)} for pk in [3, 1, 4, 5, 2]]
+        cars = dict((pk, Dummy(pk=pk)) for pk in [1, 2, 3, 4])
+        queryset = Mock(in_bulk=Mock(side_effect=lambda pks: dict((pk, cars[pk]) for pk in pks if pk in cars)))
+        with patch("elasticmodels.indexes.scan", Mock(return_value=iter(hits))) as scan:
+            results = list(CarIndex.objects.scan(CarIndex.objects.query("match", name="foo")[0:10], batch_size=2, queryset=queryset))
+
+        # the models come back in the ES order, minus the ones not in the queryset
+        self.assertEqual([car.pk for car in results], [3, 1, 4, 2])
+        # one query per batch
+        self.assertEqual([c[0][0] for c in queryset.in_bulk.call_args_list], [[3, 1], [4, 5], [2]])
+        self.assertEqual(scan.call_args[1]['size'], 2)
+        self.assertNotIn("from", scan.call_args[1]['query'])
+
+
+class MultiIndexSearchTest(TestCase):
+    def test_search(self):
+        class Car(models.Model):
+            name = models.CharField(max_length=255)
+
+        class Owner(models.Model):
+            name = models.CharField(max_length=255)
+
+        class CarIndex(Index):
+            class Meta:
+                fields = ['name']
+                model = Car
+
+        class OwnerIndex(Index):
+            class Meta:
+                fields = ['name']
+                model = Owner
+
+        search = IndexRegistry().search(CarIndex, OwnerIndex)
+        self.assertEqual(set(search._doc_type), set([CarIndex._doc_type.name, OwnerIndex._doc_type.name]))
+        self.assertEqual(search._index, [CarIndex._doc_type.index])
+
+        hits = [
+            CarIndex.from_es({"_id": "1", "_source": {}}),
+            OwnerIndex.from_es({"_id": "1", "_source": {}}),
+            CarIndex.from_es({"_id": "2", "_source": {}}),
+            CarIndex.from_es({"_id": "3", "_source": {}}),
+        ]
+        car1, car2, owner = Dummy(pk=1), Dummy(pk=2), Dummy(pk=1)
+        car_queryset = Mock(filter=Mock(return_value=[car2, car1]))
+        owner_queryset = Mock(filter=Mock(return_value=[owner]))
+        with patch.object(CarIndex, "get_queryset", Mock(return_value=car_queryset)):
+            with patch.object(OwnerIndex, "get_queryset", Mock(return_value=owner_queryset)):
+                # one query per model, in score order, without the car that
+                # isn't in the database
+                self.assertEqual(hydrate(hits), [car1, owner, car2])
+                car_queryset.filter.assert_called_once_with(pk__in=["1", "2", "3"])
+                owner_queryset.filter.assert_called_once_with(pk__in=["1"])
+
+    def test_search_requires_one_connection(self):
+        with self.assertRaises(ValueError):
+            IndexRegistry().search(
+                Mock(_doc_type=Mock(using="default")),
+                Mock(_doc_type=Mock(using="other")),
+            )
+
+
+class GetTest(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        class Car(models.Model):
+            name = models.CharField(max_length=255)
+
+        class CarIndex(Index):
+            class Meta:
+                fields = ['name']
+                model = Car
+
+        self.Car = Car
+        self.CarIndex = CarIndex
+        self.es = Mock(mget=Mock(return_value={"docs": [
+            {"_id": "2", "_type": CarIndex._doc_type.name, "found": True, "_source": {"name": "two"}},
+            {"_id": "3", "_type": CarIndex._doc_type.name, "found": False},
+            {"_id": "1", "_type": CarIndex._doc_type.name, "found": True, "_source": {"name": "one"}},
+        ]}))
+
+    def test_mget(self):
+        car1, car2 = Dummy(pk=1), Dummy(pk=2)
+        queryset = Mock(filter=Mock(return_value=[car1, car2]))
+        with patch("elasticmodels.indexes.Index.es", self.es):
+            self.assertEqual(self.CarIndex.objects.mget([2, 3, 1], queryset=queryset), [car2, car1])
+            self.assertTrue(self.es.mget.call_args[1]['realtime'])
+            self.assertEqual(self.es.mget.call_args[1]['body'], {"ids": ["2", "3", "1"]})
+            self.assertFalse(self.es.mget.call_args[1]['_source'])
+
+            results = self.CarIndex.objects.mget([2, 3, 1], source_only=True)
+            self.assertEqual([(r.pk, r.name) for r in results], [(2, "two"), (1, "one")])
+
+    def test_get(self):
+        self.es.mget.return_value = {"docs": [{"_id": "3", "_type": self.CarIndex._doc_type.name, "found": False}]}
+        with patch("elasticmodels.indexes.Index.es", self.es):
+            with self.assertRaises(self.Car.DoesNotExist):
+                self.CarIndex.objects.get(3, source_only=True)
+
+
+class PartitionTest(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        class Event(models.Model):
+            name = models.CharField(max_length=255)
+            created_on = models.DateTimeField()
+
+        class EventIndex(Index):
+            class Meta:
+                fields = ['name']
+                model = Event
+                doc_type = "elasticmodels_event"
+                date_field = "created_on"
+                partition = "month"
+
+        self.Event = Event
+        self.EventIndex = EventIndex
+        self.index_name = settings.ELASTICSEARCH_CONNECTIONS['default']['index_name']
+
+    def test_meta_is_checked(self):
+        with self.assertRaises(InvalidPartitionError):
+            class EventIndex(Index):
+                class Meta:
+                    model = self.Event
+                    partition = "month"
+
+        with self.assertRaises(InvalidPartitionError):
+            class EventIndex(Index):
+                class Meta:
+                    model = self.Event
+                    date_field = "created_on"
+                    partition = "fortnight"
+
+    def test_names(self):
+        self.assertEqual(self.EventIndex._doc_type.index, "%s-elasticmodels_event-*" % self.index_name)
+        event = self.Event(pk=1, name="foo", created_on=datetime.datetime(2015, 4, 30, 23, 0, tzinfo=utc))
+        self.assertEqual(self.EventIndex.objects.index_for(event), "%s-elasticmodels_event-2015.04" % self.index_name)
+        self.assertEqual(self.EventIndex.objects.partitions(datetime.date(2014, 11, 15), datetime.date(2015, 2, 1)), [
+            "%s-elasticmodels_event-%s" % (self.index_name, suffix)
+            for suffix in ["2014.11", "2014.12", "2015.01", "2015.02"]
+        ])
+
+    def test_update(self):
+        event = self.Event(pk=1, name="foo", created_on=datetime.datetime(2015, 4, 13, tzinfo=utc))
+        with patch("elasticmodels.indexes.Index.bulk") as bulk:
+            self.EventIndex.objects.update(event)
+            self.assertEqual(bulk.call_args[0][0][0]['_index'], "%s-elasticmodels_event-2015.04" % self.index_name)
+
+    def test_search(self):
+        search = self.EventIndex.objects.all(start=datetime.date(2015, 3, 5), end=datetime.date(2015, 4, 1))
+        self.assertEqual(search._index, [
+            "%s-elasticmodels_event-2015.03" % self.index_name,
+            "%s-elasticmodels_event-2015.04" % self.index_name,
+        ])
+        self.assertEqual(search.to_dict()['query']['filtered']['filter'], {
+            "range": {"created_on": {"gte": datetime.date(2015, 3, 5), "lte": datetime.date(2015, 4, 1)}}
+        })
+        self.assertTrue(search._params['ignore_unavailable'])
+
+        # without a range, every partition is searched
+        self.assertEqual(self.EventIndex.objects.all()._index, ["%s-elasticmodels_event-*" % self.index_name])
+
+    def test_drop_partitions(self):
+        names = ["%s-elasticmodels_event-%s" % (self.index_name, suffix) for suffix in ["2015.01", "2015.02", "2015.03"]]
+        es = Mock()
+        es.indices.get_alias = Mock(return_value=dict((name, {}) for name in names + ["unrelated"]))
+        with patch("elasticmodels.indexes.Index.es", es):
+            # open ended ranges only include the partitions that exist
+            self.assertEqual(self.EventIndex.objects.partitions(start=datetime.date(2015, 2, 20)), names[1:])
+            self.assertEqual(self.EventIndex.objects.drop_partitions(datetime.date(2015, 2, 20)), names[:1])
+            es.indices.delete.assert_called_once_with(index=names[0])
+
+
+class RoutingTest(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        class Tenant(models.Model):
+            name = models.CharField(max_length=255)
+
+        class Widget(models.Model):
+            name = models.CharField(max_length=255)
+            tenant = models.ForeignKey(Tenant)
+
+        class WidgetIndex(Index):
+            class Meta:
+                fields = ['name']
+                model = Widget
+                routing = "tenant.pk"
+
+        self.Tenant = Tenant
+        self.Widget = Widget
+        self.WidgetIndex = WidgetIndex
+
+    def test_mapping_requires_routing(self):
+        mapping = self.WidgetIndex._doc_type.mapping.to_dict()[self.WidgetIndex._doc_type.name]
+        self.assertEqual(mapping['_routing'], {"required": True})
+
+    def test_update(self):
+        widget = self.Widget(pk=1, name="foo", tenant=self.Tenant(pk=5))
+        with patch("elasticmodels.indexes.Index.bulk") as bulk:
+            self.WidgetIndex.objects.update(widget)
+            self.assertEqual(bulk.call_args[0][0][0]['_routing'], "5")
+            self.WidgetIndex.objects.delete(widget)
+            self.assertEqual(bulk.call_args[0][0][0]['_routing'], "5")
+
+    def test_search(self):
+        self.assertEqual(self.WidgetIndex.objects.filter("term", name="foo", routing=5)._params, {"routing": "5"})
+        self.assertEqual(self.WidgetIndex.objects.query("match", name="foo", routing=[5, 6])._params, {"routing": "5,6"})
+        self.assertEqual(self.WidgetIndex.objects.all()._params, {})
+
+        # the routing is used by counts too
+        es = Mock(count=Mock(return_value={"count": 1}))
+        with patch("elasticmodels.search.get_connection", Mock(return_value=es)):
+            self.WidgetIndex.objects.all(routing=5).count()
+            self.assertEqual(es.count.call_args[1]['routing'], "5")
+
+    def test_delete_pks(self):
+        # ES 1.x returns the routing under "fields"
+        hits = [{"_id": "1", "_index": "foo", "fields": {"_routing": "5"}}]
+        with patch("elasticmodels.indexes.scan", Mock(return_value=hits)) as scan, \
+                patch("elasticmodels.indexes.Index.bulk") as bulk, \
+                patch("elasticmodels.indexes.Index.es", Mock()):
+            self.WidgetIndex.objects.delete_pks([1, 2])
+            self.assertEqual(scan.call_args[1]['query']['fields'], ["_routing"])
+            self.assertEqual(bulk.call_args[0][0], [{
+                "_op_type": "delete",
+                "_index": "foo",
+                "_type": self.WidgetIndex._doc_type.mapping.doc_type,
+                "_id": "1",
+                "_routing": "5",
+            }])
+
+
+class VersionTest(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        class Car(models.Model):
+            name = models.CharField(max_length=255)
+            modified_on = models.DateTimeField()
+
+        class CarIndex(Index):
+            class Meta:
+                fields = ['name']
+                model = Car
+                version_field = "modified_on"
+
+        self.Car = Car
+        self.CarIndex = CarIndex
+
+    def test_operation(self):
+        car = self.Car(pk=1, name="foo", modified_on=datetime.datetime(2015, 4, 13, 0, 0, 1, 500, tzinfo=utc))
+        operation = self.CarIndex.objects.operation(car)
+        self.assertEqual(operation['_version'], 1428883201000)
+        self.assertEqual(operation['_version_type'], "external_gte")
+
+    def test_conflicts_are_ignored(self):
+        with patch("elasticmodels.indexes.bulk") as bulk, patch("elasticmodels.indexes.Index.es", Mock()):
+            self.CarIndex.objects.bulk([])
+            self.assertEqual(bulk.call_args[1]['ignore_status'], (409,))
+
+
+class DjangoJSONSerializerTest(TestCase):
+    def test_dumps(self):
+        serializer = DjangoJSONSerializer()
+        data = {
+            "decimal": Decimal("1.5"),
+            "uuid": uuid.UUID("12345678123456781234567812345678"),
+            "lazy": ugettext_lazy("foo"),
+            "date": datetime.datetime(2015, 4, 13, 1, 2, 3, tzinfo=utc),
+        }
+        self.assertEqual(json.loads(serializer.dumps(data)), {
+            "decimal": 1.5,
+            "uuid": "12345678-1234-5678-1234-567812345678",
+            "lazy": "foo",
+            "date": "2015-04-13T01:02:03+00:00",
+        })
+        # strings are already serialized
+        self.assertEqual(serializer.dumps('{"a": 1}'), '{"a": 1}')
+        self.assertEqual(serializer.loads('{"a": 1}'), {"a": 1})
+
+        with self.assertRaises(SerializationError):
+            serializer.dumps({"a": object()})
+
+    def test_connection_setting(self):
+        registry = IndexRegistry()
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {
+            "index_name": "bar",
+            "serializer": "elasticmodels.serializers.DjangoJSONSerializer",
+        }}):
+            with patch("elasticmodels.indexes.connections"):
+                registry.configure()
+        self.assertIsInstance(registry.connection_kwargs["foo"]["serializer"], DjangoJSONSerializer)
+
+
+class LazyConnectionTest(TestCase):
+    def test_get_connection(self):
+        registry = IndexRegistry()
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar", "hosts": ["localhost"]}}):
+            with patch("elasticmodels.indexes.connections") as connections:
+                # registering doesn't touch the connections
+                registry.register(Mock(), Mock())
+                self.assertFalse(connections.configure.called)
+
+                # the client is created on first use
+                registry.get_connection("foo")
+                registry.get_connection("foo")
+                connections.create_connection.assert_called_once_with(
+                    "foo",
+                    hosts=["localhost"],
+                    maxsize=25,
+                    timeout=30,
+                    retry_on_timeout=True,
+                )
+
+                # and created again in a forked process
+                with patch("elasticmodels.indexes.os.getpid", Mock(return_value=-1)):
+                    registry.get_connection("foo")
+                self.assertEqual(connections.create_connection.call_count, 2)
+
+
+class CompressedHttpConnectionTest(TestCase):
+    def test_body_is_compressed(self):
+        connection = CompressedHttpConnection()
+        self.assertEqual(connection.headers["content-encoding"], "gzip")
+        with patch("elasticmodels.connection.Urllib3HttpConnection.perform_request") as perform_request:
+            connection.perform_request("POST", "/_bulk", body='{"a": 1}\n')
+            self.assertEqual(gzip.decompress(perform_request.call_args[0][3]), b'{"a": 1}\n')
+
+    def test_compress_setting(self):
+        registry = IndexRegistry()
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar", "compress": True, "maxsize": 50}}):
+            with patch("elasticmodels.indexes.connections"):
+                registry.configure()
+        kwargs = registry.connection_kwargs["foo"]
+        self.assertEqual(kwargs["connection_class"], CompressedHttpConnection)
+        # the settings win over the defaults
+        self.assertEqual(kwargs["maxsize"], 50)
+        self.assertEqual(kwargs["timeout"], 30)
+        self.assertNotIn("compress", kwargs)
+
+
+class AdaptiveBulkTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = Mock()
+        self.client.transport.serializer.dumps = json.dumps
+        self.actions = [{"_op_type": "index", "_index": "foo", "_type": "car", "_id": i, "_source": {"i": i}} for i in range(4)]
+
+    def response(self, *statuses):
+        return {"items": [{"index": {"status": status}} for status in statuses]}
+
+    def test_retries_rejected_actions(self):
+        self.client.bulk = Mock(side_effect=[self.response(201, 429, 201, 429), self.response(201, 201)])
+        with patch("elasticmodels.bulk.time.sleep") as sleep:
+            self.assertEqual(adaptive_bulk(self.client, self.actions, refresh=True), (4, []))
+            self.assertTrue(sleep.called)
+
+        # only the rejected actions are retried
+        retried = self.client.bulk.call_args_list[1][1]['body'].splitlines()
+        self.assertEqual([json.loads(line)["index"]["_id"] for line in retried[::2]], [1, 3])
+        # a single chunk is refreshed as part of the bulk request
+        self.assertTrue(self.client.bulk.call_args[1]['refresh'])
+        self.assertFalse(self.client.indices.refresh.called)
+
+    def test_refresh_after_chunks(self):
+        self.client.bulk = Mock(return_value=self.response(201, 201))
+        self.assertEqual(adaptive_bulk(self.client, self.actions, refresh=True, chunk_size=2), (4, []))
+        self.assertEqual(self.client.bulk.call_count, 2)
+        # the index is refreshed once at the end, instead of with each chunk
+        self.assertNotIn("refresh", self.client.bulk.call_args[1])
+        self.client.indices.refresh.assert_called_once_with(index="foo")
+
+    def test_chunk_size_adapts(self):
+        sender = AdaptiveBulkSender(self.client, chunk_size=100, target_latency=1)
+        sender.adapt(0.1)
+        self.assertEqual(sender.chunk_size, 151)
+        sender.adapt(5)
+        self.assertEqual(sender.chunk_size, 75)
+
+        # chunks are limited by the number of bytes too
+        sender = AdaptiveBulkSender(self.client, chunk_size=100, max_chunk_bytes=150)
+        self.assertEqual([len(chunk) for chunk in sender.chunks(self.actions)], [2, 2])
+
+    def test_dead_letter(self):
+        dead_letter = os.path.join(tempfile.mkdtemp(), "dead.ndjson")
+        self.client.bulk = Mock(side_effect=[self.response(201, 400, 409, 429), self.response(429)])
+        with patch("elasticmodels.bulk.time.sleep"):
+            success, errors = adaptive_bulk(self.client, self.actions, raise_on_error=False, dead_letter=dead_letter, ignore_status=(409,), max_retries=1)
+        self.assertEqual(success, 2)
+        self.assertEqual(len(errors), 2)
+        with open(dead_letter) as f:
+            self.assertEqual([json.loads(line)["action"]["_id"] for line in f], [1, 3])
+
+        self.client.bulk = Mock(return_value=self.response(201, 400, 201, 201))
+        with self.assertRaises(BulkIndexError):
+            adaptive_bulk(self.client, self.actions)
+
+
 class IndexRegistryTest(ESTest):
     def test(self):
         r = IndexRegistry()
@@ -481,19 +1188,364 @@ class UpdateCommandTest(ESTest):
         cmd = UpdateCommand()
         model = Dummy()
         index = Mock()
-        index.get_queryset = Mock(return_value=Mock(count=lambda: 1))
+        index.get_queryset = Mock(return_value=FakeQuerySet([Dummy(pk=1)]))
         index._doc_type.using = "foo"
         index._doc_type.mapping._collect_analysis = lambda: {}
         index._doc_type.mapping.to_dict = lambda: {}
+        index.update = Mock(return_value=(1, []))
         index2 = Mock()
+        checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
         with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
             with patch("elasticmodels.management.commands.update_index.get_models", Mock(return_value=[model])):
                 with patch("elasticmodels.management.commands.registry.indexes_for_model", Mock(return_value=[index, index2])):
-                    cmd.handle(start="2010-10-10", end="2011-11-11", using=["foo"])
+                    cmd.handle(start="2010-10-10", end="2011-11-11", using=["foo"], checkpoint=checkpoint)
                     # TODO more asserts
                     self.assertTrue(index.update.called)
                     self.assertFalse(index2.update.called)
 
+                    with patch("elasticmodels.management.commands.update_index.bulk_mode") as bulk_mode:
+                        cmd.handle(using=["foo"], bulk_mode=True, checkpoint=checkpoint)
+                        bulk_mode.assert_called_once_with("foo")
+                        # the index is refreshed once at the end instead
+                        self.assertFalse(index.update.call_args[1]['refresh'])
+
+
+class IndicesTest(TestCase):
+    def test_swap_alias(self):
+        es = Mock()
+        es.indices.exists_alias = Mock(return_value=True)
+        es.indices.get_alias = Mock(return_value={"bar_1": {}, "bar_2": {}})
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
+            with patch("elasticmodels.indices.registry.get_connection", Mock(return_value=es)):
+                self.assertEqual(swap_alias("foo", "bar_2"), ["bar_1"])
+                es.indices.update_aliases.assert_called_once_with(body={"actions": [
+                    {"remove": {"index": "bar_1", "alias": "bar"}},
+                    {"add": {"index": "bar_2", "alias": "bar"}},
+                ]})
+                self.assertFalse(es.indices.delete.called)
+
+                swap_alias("foo", "bar_2", delete_old=True)
+                es.indices.delete.assert_called_once_with(index="bar_1")
+
+    def test_swap_alias_replaces_concrete_index(self):
+        es = Mock()
+        es.indices.exists_alias = Mock(return_value=False)
+        es.indices.exists = Mock(return_value=True)
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
+            with patch("elasticmodels.indices.registry.get_connection", Mock(return_value=es)):
+                with self.assertRaises(ValueError):
+                    swap_alias("foo", "bar_2")
+                self.assertFalse(es.indices.delete.called)
+
+                swap_alias("foo", "bar_2", delete_old=True)
+                es.indices.delete.assert_called_once_with(index="bar")
+                es.indices.put_alias.assert_called_once_with(index="bar_2", name="bar")
+
+
+    def test_copy_from_source(self):
+        es = Mock()
+        hits = [
+            {"_index": "bar_1", "_type": "car", "_id": "1", "_source": {"name": "a"}},
+            {"_index": "bar_1", "_type": "car", "_id": "2", "_source": {"name": "b"}, "fields": {"_routing": "x"}},
+        ]
+        actions = []
+
+        def bulk(client, items, **kwargs):
+            actions.extend(items)
+            return len(actions), []
+
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
+            with patch("elasticmodels.indices.registry.get_connection", Mock(return_value=es)), \
+                    patch("elasticmodels.indices.registry.indexes_for_connection", Mock(return_value=[])), \
+                    patch("elasticmodels.indices.scan", Mock(return_value=iter(hits))) as scan, \
+                    patch("elasticmodels.indices.bulk", Mock(side_effect=bulk)) as bulk_mock:
+                self.assertEqual(copy_from_source("foo", "bar_2"), (2, []))
+                self.assertEqual(scan.call_args[1]['index'], "bar")
+                # the routing has to be asked for
+                self.assertIn("_routing", scan.call_args[1]['query']['fields'])
+                # the errors are reported, instead of stopping the copy
+                self.assertFalse(bulk_mock.call_args[1]['raise_on_error'])
+
+        self.assertEqual(actions, [
+            {"_op_type": "index", "_index": "bar_2", "_type": "car", "_id": "1", "_source": {"name": "a"}},
+            {"_op_type": "index", "_index": "bar_2", "_type": "car", "_id": "2", "_source": {"name": "b"}, "_routing": "x"},
+        ])
+
+    def test_copy_from_source_keeps_versions(self):
+        es = Mock()
+        index = Mock()
+        index._doc_type.version_field = "modified_on"
+        hits = [{"_index": "bar_1", "_type": "car", "_id": "1", "_version": 1428886861000, "_source": {"name": "a"}}]
+        actions = []
+
+        def bulk(client, items, **kwargs):
+            actions.extend(items)
+            return len(actions), []
+
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
+            with patch("elasticmodels.indices.registry.get_connection", Mock(return_value=es)), \
+                    patch("elasticmodels.indices.registry.indexes_for_connection", Mock(return_value=[index])), \
+                    patch("elasticmodels.indices.scan", Mock(return_value=iter(hits))) as scan, \
+                    patch("elasticmodels.indices.bulk", Mock(side_effect=bulk)):
+                copy_from_source("foo", "bar_2")
+                self.assertTrue(scan.call_args[1]['query']['version'])
+
+        # a stale write with an older timestamp can't beat the copied document
+        self.assertEqual(actions[0]['_version'], 1428886861000)
+        self.assertEqual(actions[0]['_version_type'], "external")
+
+    def test_bulk_mode(self):
+        es = Mock()
+        es.indices.exists_alias = Mock(return_value=True)
+        es.indices.get_alias = Mock(return_value={"bar_1": {}})
+        es.indices.get_settings = Mock(return_value={"bar_1": {"settings": {
+            "index.refresh_interval": "30s",
+            "index.number_of_replicas": "2",
+        }}})
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
+            with patch("elasticmodels.indices.registry.get_connection", Mock(return_value=es)):
+                with self.assertRaises(KeyboardInterrupt):
+                    with bulk_mode("foo"):
+                        es.indices.put_settings.assert_called_once_with(index="bar_1", body={"index": {
+                            "refresh_interval": "-1",
+                            "number_of_replicas": 0,
+                        }})
+                        raise KeyboardInterrupt()
+
+                # the settings are restored, even though the load was interrupted
+                es.indices.put_settings.assert_called_with(index="bar_1", body={"index": {
+                    "refresh_interval": "30s",
+                    "number_of_replicas": "2",
+                }})
+                es.indices.refresh.assert_called_once_with(index="bar_1")
+
+    def test_configured_settings(self):
+        es = Mock()
+        es.indices.get_settings = Mock(return_value={"bar_1": {"settings": {
+            "index.refresh_interval": "1s",
+            "index.number_of_shards": "5",
+            "index.number_of_replicas": "1",
+        }}})
+        configured = {"refresh_interval": "30s", "number_of_shards": 2, "number_of_replicas": 1}
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
+            with patch("elasticmodels.indices.registry.get_connection", Mock(return_value=es)), \
+                    patch("elasticmodels.indices.registry.index_settings", {"foo": configured}), \
+                    patch("elasticmodels.indices.registry.indexes_for_connection", Mock(return_value=[])), \
+                    patch("elasticmodels.indices.collect_analysis", Mock(return_value={})):
+                # the values ES returns are strings
+                self.assertEqual(changed_settings("foo", "bar_1"), ({"refresh_interval": "30s"}, {"number_of_shards": 2}))
+
+                # the configured settings are used at creation, but the extra
+                # settings win
+                create_index("foo", "bar_2", extra_settings={"index": {"refresh_interval": "-1"}})
+                es.indices.create.assert_called_once_with(index="bar_2", body={"settings": {
+                    "analysis": {},
+                    "index": {"refresh_interval": "-1", "number_of_shards": 2, "number_of_replicas": 1},
+                }})
+
+
+class RebuildCommandTest(TestCase):
+    def test_swap(self):
+        cmd = RebuildCommand()
+        index = Mock()
+        index._doc_type.model = Dummy(__name__="Car")
+        index._doc_type.partition = None
+        index._doc_type.date_field = None
+        index.get_queryset = Mock(return_value=FakeQuerySet([Dummy(pk=1), Dummy(pk=2), Dummy(pk=3)]))
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
+            with patch("elasticmodels.management.commands.rebuild_index.registry.indexes_for_connection", Mock(return_value=[index])), \
+                    patch("elasticmodels.management.commands.rebuild_index.physical_indices", Mock(return_value=["bar_1"])) as physical_indices, \
+                    patch("elasticmodels.management.commands.rebuild_index.new_index_name", Mock(return_value="bar_2")), \
+                    patch("elasticmodels.management.commands.rebuild_index.create_index") as create_index, \
+                    patch("elasticmodels.management.commands.rebuild_index.finish_bulk_load") as finish_bulk_load, \
+                    patch("elasticmodels.management.commands.rebuild_index.swap_alias") as swap_alias:
+                cmd.handle(using=["foo"], swap=True, chunk_size=2)
+                self.assertEqual(create_index.call_args[0], ("foo", "bar_2"))
+                # the objects are indexed a chunk at a time
+                self.assertEqual([[obj.pk for obj in call[0][0]] for call in index.update.call_args_list], [[1, 2], [3]])
+                self.assertEqual(index.update.call_args[1]['index'], "bar_2")
+                finish_bulk_load.assert_called_once_with("foo", "bar_2", restore_from="bar_1")
+                swap_alias.assert_called_once_with("foo", "bar_2", delete_old=None)
+
+                # the objects saved during the load are indexed again before
+                # the alias is moved
+                index.reset_mock()
+                index._doc_type.date_field = "modified_on"
+                cmd.handle(using=["foo"], swap=True)
+                self.assertEqual(index.get_queryset.call_count, 2)
+                self.assertIsNotNone(index.get_queryset.call_args[1]['start'])
+
+                # a concrete index can only be replaced with --delete-old, and
+                # that is checked before anything is loaded
+                create_index.reset_mock()
+                physical_indices.return_value = ["bar"]
+                with self.assertRaises(CommandError):
+                    cmd.handle(using=["foo"], swap=True)
+                self.assertFalse(create_index.called)
+
+            with self.assertRaises(CommandError):
+                cmd.handle("app", using=["foo"], swap=True)
+
+    def test_swap_from_source(self):
+        cmd = RebuildCommand()
+        index = Mock()
+        index._doc_type.source_excludes = ()
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
+            with patch("elasticmodels.management.commands.rebuild_index.registry.indexes_for_connection", Mock(return_value=[index])), \
+                    patch("elasticmodels.management.commands.rebuild_index.physical_indices", Mock(return_value=["bar_1"])), \
+                    patch("elasticmodels.management.commands.rebuild_index.new_index_name", Mock(return_value="bar_2")), \
+                    patch("elasticmodels.management.commands.rebuild_index.create_index"), \
+                    patch("elasticmodels.management.commands.rebuild_index.copy_from_source", Mock(return_value=(1, []))) as copy, \
+                    patch("elasticmodels.management.commands.rebuild_index.finish_bulk_load"), \
+                    patch("elasticmodels.management.commands.rebuild_index.swap_alias") as swap_alias:
+                cmd.handle(using=["foo"], swap=True, from_source=True)
+                copy.assert_called_once_with("foo", "bar_2")
+                # the database isn't touched
+                self.assertFalse(index.update.called)
+                self.assertTrue(swap_alias.called)
+
+                # the alias isn't moved if any documents failed to copy
+                swap_alias.reset_mock()
+                copy.return_value = (0, [{"index": {"_id": "1", "status": 400}}])
+                with self.assertRaises(CommandError):
+                    cmd.handle(using=["foo"], swap=True, from_source=True)
+                self.assertFalse(swap_alias.called)
+
+                # documents that are missing fields in their _source can't be
+                # copied
+                index._doc_type.source_excludes = ("body",)
+                with self.assertRaises(CommandError):
+                    cmd.handle(using=["foo"], swap=True, from_source=True)
+
+            with self.assertRaises(CommandError):
+                cmd.handle(using=["foo"], from_source=True)
+
+
+class SinceLastTest(TestCase):
+    def test_since_last(self):
+        cmd = UpdateCommand()
+        index = Mock()
+        index._doc_type.using = "foo"
+        index._doc_type.mapping.doc_type = "car"
+        index._doc_type.date_field = "modified_on"
+        index._doc_type.model.__name__ = "Car"
+        index.get_queryset = Mock(return_value=FakeQuerySet([Dummy(pk=1)]))
+        index.update = Mock(return_value=(1, []))
+        no_date_field = Mock()
+        no_date_field._doc_type.using = "foo"
+        no_date_field._doc_type.date_field = None
+        directory = tempfile.mkdtemp()
+        options = dict(
+            using=["foo"],
+            since_last=True,
+            margin="10m",
+            checkpoint=os.path.join(directory, "checkpoint.json"),
+            watermarks=os.path.join(directory, "watermarks.json"),
+        )
+        first = datetime.datetime(2015, 4, 13, 1, 1, 1, tzinfo=utc)
+        second = datetime.datetime(2015, 4, 14, 1, 1, 1, tzinfo=utc)
+
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
+            with patch("elasticmodels.management.commands.update_index.get_models", Mock(return_value=[Dummy()])):
+                with patch("elasticmodels.management.commands.registry.indexes_for_model", Mock(return_value=[index, no_date_field])):
+                    # the first run indexes everything
+                    with patch.object(cmd, "get_high_watermark", Mock(return_value=first)):
+                        cmd.handle(**options)
+                    self.assertEqual(index.get_queryset.call_args[1]['start'], None)
+                    self.assertEqual(load_state(options['watermarks']), {"foo:car": first.isoformat()})
+                    # indexes without a date_field are skipped
+                    self.assertFalse(no_date_field.update.called)
+
+                    # the next run starts at the watermark, minus the margin
+                    with patch.object(cmd, "get_high_watermark", Mock(return_value=second)):
+                        cmd.handle(**options)
+                    self.assertEqual(index.get_queryset.call_args[1]['start'], first - datetime.timedelta(minutes=10))
+                    self.assertEqual(load_state(options['watermarks']), {"foo:car": second.isoformat()})
+
+                    # if there was nothing to index, the watermark stays put
+                    with patch.object(cmd, "get_high_watermark", Mock(return_value=None)):
+                        cmd.handle(**options)
+                    self.assertEqual(load_state(options['watermarks']), {"foo:car": second.isoformat()})
+
+                    # if some objects went to the dead letter file, the watermark
+                    # stays put, so the next run tries them again
+                    index.update = Mock(return_value=(0, [{"index": {"_id": "1", "status": 400}}]))
+                    third = second + datetime.timedelta(days=1)
+                    with patch.object(cmd, "get_high_watermark", Mock(return_value=third)):
+                        cmd.handle(dead_letter=os.path.join(directory, "dead.ndjson"), **options)
+                    self.assertFalse(index.update.call_args[1]['raise_on_error'])
+                    self.assertEqual(load_state(options['watermarks']), {"foo:car": second.isoformat()})
+
+
+class KeysetChunksTest(TestCase):
+    def test_keyset_chunks(self):
+        qs = FakeQuerySet(Dummy(pk=pk) for pk in [5, 3, 1, 4, 2])
+        self.assertEqual([[obj.pk for obj in chunk] for chunk in keyset_chunks(qs, 2)], [[1, 2], [3, 4], [5]])
+        self.assertEqual([[obj.pk for obj in chunk] for chunk in keyset_chunks(qs, 2, after=3)], [[4, 5]])
+
+    def test_resume(self):
+        cmd = UpdateCommand()
+        objects = FakeQuerySet(Dummy(pk=pk) for pk in [1, 2, 3, 4, 5])
+        index = Mock()
+        index._doc_type.using = "foo"
+        index._doc_type.mapping.doc_type = "car"
+        index._doc_type.model.__name__ = "Car"
+        index._doc_type.model._meta.pk.to_python = int
+        index.get_queryset = Mock(return_value=objects)
+        # blow up while indexing the second chunk
+        index.update = Mock(side_effect=[(2, []), KeyboardInterrupt()])
+        checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
+
+        with self.settings(ELASTICSEARCH_CONNECTIONS={"foo": {"index_name": "bar"}}):
+            with patch("elasticmodels.management.commands.update_index.get_models", Mock(return_value=[Dummy()])):
+                with patch("elasticmodels.management.commands.registry.indexes_for_model", Mock(return_value=[index])):
+                    with self.assertRaises(KeyboardInterrupt):
+                        cmd.handle(using=["foo"], chunk_size=2, checkpoint=checkpoint)
+                    self.assertEqual(load_state(checkpoint), {"foo:car": 2})
+
+                    index.update = Mock(return_value=(2, []))
+                    cmd.handle(using=["foo"], chunk_size=2, checkpoint=checkpoint, resume=True)
+                    self.assertEqual([[obj.pk for obj in c[0][0]] for c in index.update.call_args_list], [[3, 4], [5]])
+                    # the run finished, so the checkpoint is gone
+                    self.assertFalse(os.path.exists(checkpoint))
+
+
+class ReconcileCommandTest(TestCase):
+    def test_merge_join(self):
+        self.assertEqual(list(merge_join([1, 2, 4, 6], [2, 3, 4, 5])), [
+            (1, True, False),
+            (2, True, True),
+            (3, False, True),
+            (4, True, True),
+            (5, False, True),
+            (6, True, False),
+        ])
+        with self.assertRaises(ValueError):
+            list(merge_join([2, 1], [1, 2]))
+
+    def test_reconcile(self):
+        cmd = ReconcileCommand()
+        index = Mock()
+        qs = Mock()
+        index.get_queryset = Mock(return_value=qs)
+        with patch.object(cmd, "es_pks", Mock(return_value=iter([1, 2, 4, 6, 7]))):
+            with patch("elasticmodels.management.commands.reconcile_index.keyset_pks", Mock(return_value=iter([2, 3, 4, 5]))):
+                cmd.reconcile(index, chunk_size=2)
+
+        self.assertEqual([c[0][0] for c in index.delete_pks.call_args_list], [[1, 6], [7]])
+        self.assertEqual([c[1] for c in qs.filter.call_args_list], [{"pk__in": [3, 5]}])
+        self.assertEqual(index.update.call_count, 1)
+
+    def test_dry_run(self):
+        cmd = ReconcileCommand()
+        index = Mock()
+        with patch.object(cmd, "es_pks", Mock(return_value=iter([1, 2]))):
+            with patch("elasticmodels.management.commands.reconcile_index.keyset_pks", Mock(return_value=iter([2, 3]))):
+                cmd.reconcile(index, chunk_size=10, dry_run=True)
+
+        self.assertFalse(index.delete_pks.called)
+        self.assertFalse(index.update.called)
+
 
 class ClearCommandTest(TestCase):
     def test_handle(self):
@@ -574,6 +1626,123 @@ class BaseSearchFormTest(TestCase):
                     self.assertEqual(type(form.results()), Pageable)
 
 
+    def test_results_without_prevalidation(self):
+        class Form(BaseSearchForm):
+            prevalidate_query = False
+
+        form = Form({"q": "foo"}, index=Mock())
+        search = Mock(spec=Search)
+        search.count = Mock(return_value=5)
+        with patch("elasticmodels.forms.BaseSearchForm.search", return_value=search):
+            with patch("elasticmodels.forms.BaseSearchForm.is_valid_query") as is_valid_query:
+                results = form.results()
+                self.assertFalse(is_valid_query.called)
+                self.assertEqual(type(results), Pageable)
+                # the count is remembered, so the Paginator doesn't ask ES again
+                self.assertEqual(results.count(), 5)
+                self.assertEqual(search.count.call_count, 1)
+
+        # a query ES can't parse becomes a form error
+        form = Form({"q": "foo"}, index=Mock())
+        search.count = Mock(side_effect=RequestError(400, "SearchPhaseExecutionException", {}))
+        with patch("elasticmodels.forms.BaseSearchForm.search", return_value=search):
+            self.assertEqual(form.results(), [])
+            self.assertEqual(form.non_field_errors().as_data()[0].code, "invalid-query")
+
+    def test_validation_cache(self):
+        class Form(BaseSearchForm):
+            validation_cache_size = 1
+
+        index = Mock()
+        index.objects.es.indices.validate_query = Mock(return_value={"valid": True})
+        form = Form({"q": "foo"}, index=index)
+        with patch("elasticmodels.forms.validation_cache", OrderedDict()) as cache:
+            self.assertTrue(form.is_valid_query(Search().query("match", foo="bar")))
+            self.assertTrue(form.is_valid_query(Search().query("match", foo="bar")))
+            self.assertEqual(index.objects.es.indices.validate_query.call_count, 1)
+            # a different query evicts the first one
+            self.assertTrue(form.is_valid_query(Search().query("match", foo="baz")))
+            self.assertEqual(index.objects.es.indices.validate_query.call_count, 2)
+            self.assertEqual(len(cache), 1)
+
+
+class AsyncSearchTest(TestCase):
+    def run_async(self, coro):
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def test_aexecute(self):
+        async def search(**kwargs):
+            return {"hits": {"hits": [], "total": 0}}
+
+        async def count(**kwargs):
+            return {"count": 7}
+
+        es = Mock(search=Mock(side_effect=search), count=Mock(side_effect=count))
+        with patch("elasticmodels.search.get_async_connection", Mock(return_value=es)):
+            search = IndexSearch(index="foo", doc_type="bar").query("match", name="baz")
+            self.assertEqual(len(self.run_async(search.aexecute())), 0)
+            self.assertEqual(self.run_async(search.acount()), 7)
+            self.assertEqual(es.search.call_args[1]['body'], search.to_dict())
+
+    def test_async_connection_per_loop(self):
+        class FakeAsyncElasticsearch:
+            def __init__(self, loop, **kwargs):
+                self.loop = loop
+
+        loop = asyncio.new_event_loop()
+        with patch("elasticmodels.search.AsyncElasticsearch", FakeAsyncElasticsearch), \
+                patch("elasticmodels.search.asyncio.get_event_loop", Mock(return_value=loop)):
+            client = get_async_connection("default")
+            self.assertIs(get_async_connection("default"), client)
+            self.assertIs(client.loop, loop)
+
+        # the loop and its clients can be garbage collected once the loop is
+        # done with
+        loop_ref = weakref.ref(loop)
+        loop.close()
+        del loop, client
+        gc.collect()
+        self.assertIsNone(loop_ref())
+
+    def test_async_connection_requires_elasticsearch_async(self):
+        with patch("elasticmodels.search.AsyncElasticsearch", None):
+            with self.assertRaises(ImproperlyConfigured):
+                get_async_connection("default")
+
+    def test_async_pageable(self):
+        hit = Mock(meta=Mock(id="1"))
+        car = Dummy(pk=1)
+
+        async def acount():
+            return 1
+
+        async def aexecute():
+            return [hit]
+
+        search = Mock(acount=Mock(side_effect=acount))
+        search.__getitem__ = Mock(return_value=Mock(aexecute=Mock(side_effect=aexecute)))
+        queryset = Mock(filter=Mock(return_value=[car]))
+        pageable = AsyncPageable(search, queryset)
+
+        async def collect():
+            return [item async for item in pageable]
+
+        self.assertEqual(self.run_async(collect()), [car])
+        self.assertEqual(self.run_async(pageable.acount()), 1)
+        # the count is remembered
+        self.assertEqual(search.acount.call_count, 1)
+
+    def test_aresults(self):
+        async def ais_valid_query(self, search):
+            return False
+
+        form = BaseSearchForm({"q": "foo"}, index=Mock())
+        with patch("elasticmodels.forms.BaseSearchForm.search", return_value=Search()):
+            with patch("elasticmodels.forms.BaseSearchForm.ais_valid_query", ais_valid_query):
+                self.assertEqual(self.run_async(form.aresults()), [])
+                self.assertEqual(form.non_field_errors().as_data()[0].code, "invalid-query")
+
+
 class SearchFormTest(ESTest):
     def test_results_are_filtered_based_on_queryset(self):
 
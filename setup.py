@@ -9,6 +9,8 @@ setup(
     long_description=open('README.md').read(),
     author='Matt Johnson',
     extras_require={
+        'async': ["elasticsearch-async"],
+        'orjson': ["orjson"],
         'dev': [
             "mock",
             "model_mommy",